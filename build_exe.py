@@ -9,16 +9,46 @@ import os
 import sys
 import subprocess
 import shutil
+import threading
 from pathlib import Path
 
+def _pump(pipe, sink, lines):
+    """Forward a child pipe line by line to sink, keeping a copy"""
+    for line in pipe:
+        sink.write(line)
+        sink.flush()
+        lines.append(line)
+    pipe.close()
+
+def stream_command(cmd, env=None):
+    """Run a command, streaming stdout/stderr live; return (returncode, stderr)"""
+    proc = subprocess.Popen(
+        cmd,
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        text=True,
+        bufsize=1,
+        env=env,
+    )
+    out_lines, err_lines = [], []
+    pumps = [
+        threading.Thread(target=_pump, args=(proc.stdout, sys.stdout, out_lines), daemon=True),
+        threading.Thread(target=_pump, args=(proc.stderr, sys.stderr, err_lines), daemon=True),
+    ]
+    for t in pumps:
+        t.start()
+    for t in pumps:
+        t.join()
+    return proc.wait(), "".join(err_lines)
+
 def run_command(cmd, description):
     """Run a command and print status"""
     print(f"\n[{description}]")
     print(f"Running: {' '.join(cmd)}")
-    result = subprocess.run(cmd, capture_output=True, text=True)
-    if result.returncode != 0:
+    returncode, _ = stream_command(cmd)
+    if returncode != 0:
         print(f"ERROR: {description} failed!")
-        print(result.stderr)
         return False
     return True
 
@@ -46,6 +76,12 @@ def main():
         if os.path.exists(dir_name):
             shutil.rmtree(dir_name)
             print(f"  Removed {dir_name}/")
+    # PyInstaller reuses existing .pyc files next to sources, so stale
+    # non-optimized caches in the packages must go too
+    for pkg in ["db", "ui", "utils", "staging", "export"]:
+        for cache_dir in Path(pkg).rglob("__pycache__"):
+            shutil.rmtree(cache_dir)
+            print(f"  Removed {cache_dir.as_posix()}/")
     
     # Step 3: Build
     print("\n[3/4] Building executable...")
@@ -53,11 +89,15 @@ def main():
     # Determine separator for --add-data based on OS
     separator = ";" if sys.platform == "win32" else ":"
     
+    # onedir avoids unpacking the whole bundle to a temp dir on every launch;
+    # set PYINSTALLER_ONEFILE=1 to still get a single-file artifact
+    onefile = os.environ.get("PYINSTALLER_ONEFILE") == "1"
+    
     cmd = [
         sys.executable, "-m", "PyInstaller",
         "--noconfirm",
         "--clean",
-        "--onefile",
+        "--onefile" if onefile else "--onedir",
         "--windowed",
         "--name", "thoracic_entry",
         "--icon=assets/app.ico",
@@ -71,14 +111,11 @@ def main():
         "main.py"
     ]
     
-    result = subprocess.run(cmd, capture_output=True, text=True)
-    
-    # Print output
-    print(result.stdout)
-    if result.stderr:
-        print("STDERR:", result.stderr)
+    # Strip asserts and docstrings from the bundled bytecode
+    env = {**os.environ, "PYTHONOPTIMIZE": "2"}
+    returncode, _ = stream_command(cmd, env=env)
     
-    if result.returncode != 0:
+    if returncode != 0:
         print("\nERROR: Build failed!")
         return 1
     
@@ -86,17 +123,27 @@ def main():
     print("\n[4/4] Checking output...")
     
     exe_name = "thoracic_entry.exe" if sys.platform == "win32" else "thoracic_entry"
-    exe_path = Path("dist") / exe_name
+    if onefile:
+        exe_path = Path("dist") / exe_name
+    else:
+        exe_path = Path("dist") / "thoracic_entry" / exe_name
     
     if exe_path.exists():
-        size_mb = exe_path.stat().st_size / (1024 * 1024)
+        if onefile:
+            size_bytes = exe_path.stat().st_size
+        else:
+            size_bytes = sum(p.stat().st_size for p in exe_path.parent.rglob("*") if p.is_file())
+        size_mb = size_bytes / (1024 * 1024)
         print("\n" + "=" * 50)
         print("SUCCESS!")
         print("=" * 50)
         print(f"\nExecutable location: {exe_path.absolute()}")
         print(f"File size: {size_mb:.1f} MB")
         print("\nYou can now:")
-        print("  1. Copy the exe to any computer")
+        if onefile:
+            print("  1. Copy the exe to any computer")
+        else:
+            print(f"  1. Copy the whole {exe_path.parent.name}/ folder to any computer")
         print("  2. Double-click to run (no Python needed)")
         print("  3. Program will create thoracic.db automatically")
         return 0
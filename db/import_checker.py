@@ -7,10 +7,13 @@
 from __future__ import annotations
 
 import sqlite3
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from typing import Dict, List, Set, Tuple, Optional
 from dataclasses import dataclass
 
+from .models import open_source_db
+
 
 @dataclass
 class PatientInfo:
@@ -62,59 +65,58 @@ def check_source_databases(
     # 1. 读取本地数据库的所有 hospital_id
     local_hospital_ids = _get_local_hospital_ids(local_db_path)
     
-    # 2. 读取所有源文件的患者信息
-    all_source_patients: List[PatientInfo] = []
-    source_hospital_id_map: Dict[str, List[PatientInfo]] = {}  # hospital_id -> [PatientInfo]
+    # 2. 单次遍历：读取源文件患者的同时完成分类与源间重复检测
+    total_patients = 0
+    new_patients: List[PatientInfo] = []
+    duplicate_local: List[PatientInfo] = []
+    duplicate_source_pairs: List[Tuple[PatientInfo, PatientInfo]] = []
     
-    valid_source_files = []
+    # hospital_id -> 第一次出现的患者（即将被导入的那一条）
+    first_seen: Dict[str, PatientInfo] = {}
+    # 每个源文件中将被实际导入的新患者 hospital_id（首次出现者）
+    new_ids_by_source: Dict[Path, Set[str]] = {}
     
-    for source_path in source_paths:
-        try:
-            patients = _read_patients_from_db(source_path)
-            all_source_patients.extend(patients)
-            valid_source_files.append(source_path.name)
-            
-            # 建立映射以检测源文件间的重复
-            for patient in patients:
-                if patient.hospital_id not in source_hospital_id_map:
-                    source_hospital_id_map[patient.hospital_id] = []
-                source_hospital_id_map[patient.hospital_id].append(patient)
-        except Exception as e:
-            print(f"Warning: Failed to read {source_path}: {e}")
-            continue
+    valid_source_files = []
     
-    # 3. 分类患者
-    new_patients = []
-    duplicate_local = []
-    duplicate_source_pairs = []
+    # 各源文件的读取互不依赖，用线程池并行读取（sqlite3 在 C 层释放 GIL）；
+    # 分类与去重仍在主线程按源文件顺序进行
+    if source_paths:
+        with ThreadPoolExecutor(max_workers=min(8, len(source_paths))) as executor:
+            results = list(executor.map(_read_patients_from_db_safe, source_paths))
+    else:
+        results = []
     
-    # 检测源文件间的重复
-    processed_duplicates = set()
-    for hospital_id, patient_list in source_hospital_id_map.items():
-        if len(patient_list) > 1:
-            # 有重复，只取第一个，其余标记为重复
-            new_patients.append(patient_list[0]) if hospital_id not in local_hospital_ids else duplicate_local.append(patient_list[0])
+    for source_path, patients, error in results:
+        if error is not None:
+            print(f"Warning: Failed to read {source_path}: {error}")
+            continue
+        
+        valid_source_files.append(source_path.name)
+        total_patients += len(patients)
+        source_new_ids = new_ids_by_source.setdefault(source_path, set())
+        
+        for patient in patients:
+            hospital_id = patient.hospital_id
+            first = first_seen.get(hospital_id)
+            if first is not None:
+                # 源文件间重复：只保留第一次出现的，与其组成重复对
+                duplicate_source_pairs.append((first, patient))
+                continue
+            first_seen[hospital_id] = patient
             
-            # 记录重复对
-            for i in range(len(patient_list) - 1):
-                pair_key = f"{patient_list[i].source_db}:{patient_list[i+1].source_db}:{hospital_id}"
-                if pair_key not in processed_duplicates:
-                    duplicate_source_pairs.append((patient_list[i], patient_list[i+1]))
-                    processed_duplicates.add(pair_key)
-        else:
-            # 无源间重复，检查是否与本地重复
-            patient = patient_list[0]
+            # 首次出现，检查是否与本地重复
             if hospital_id in local_hospital_ids:
                 duplicate_local.append(patient)
             else:
                 new_patients.append(patient)
+                source_new_ids.add(hospital_id)
     
-    # 4. 统计关联数据（预估）
-    estimated_stats = _estimate_related_records(source_paths, new_patients)
+    # 3. 统计关联数据（预估），只统计每位新患者首次出现的源文件
+    estimated_stats = _estimate_related_records(new_ids_by_source)
     
-    # 5. 构建分析结果
+    # 4. 构建分析结果
     analysis = ImportAnalysis(
-        total_patients=len(all_source_patients),
+        total_patients=total_patients,
         new_patients=len(new_patients),
         duplicate_in_local=len(duplicate_local),
         duplicate_in_sources=len(duplicate_source_pairs),
@@ -133,44 +135,38 @@ def check_source_databases(
 
 def _get_local_hospital_ids(db_path: Path) -> Set[str]:
     """获取本地数据库的所有 hospital_id"""
-    hospital_ids = set()
-    
     if not db_path.exists():
-        return hospital_ids
+        return set()
     
     try:
-        conn = sqlite3.connect(db_path)
-        cursor = conn.execute("SELECT hospital_id FROM Patient WHERE hospital_id IS NOT NULL")
-        for row in cursor:
-            if row[0]:
-                hospital_ids.add(row[0])
-        conn.close()
+        conn = open_source_db(db_path)
+        try:
+            # 直接迭代游标构建集合，避免 fetchall 先物化整张结果列表
+            return {
+                row[0] for row in conn.execute(
+                    "SELECT hospital_id FROM Patient WHERE hospital_id IS NOT NULL AND hospital_id != ''"
+                )
+            }
+        finally:
+            conn.close()
     except Exception as e:
         print(f"Warning: Failed to read local database: {e}")
-    
-    return hospital_ids
+        return set()
 
 
 def _read_patients_from_db(db_path: Path) -> List[PatientInfo]:
     """从数据库文件读取患者信息"""
-    patients = []
-    
     try:
-        conn = sqlite3.connect(db_path)
-        conn.row_factory = sqlite3.Row
+        conn = open_source_db(db_path)
         cursor = conn.execute(
             "SELECT hospital_id, cancer_type, sex FROM Patient WHERE hospital_id IS NOT NULL"
         )
-        
-        for row in cursor:
-            patient = PatientInfo(
-                hospital_id=row['hospital_id'],
-                cancer_type=row['cancer_type'],
-                sex=row['sex'],
-                source_db=db_path.name
-            )
-            patients.append(patient)
-        
+        source_db = db_path.name
+        # 直接按位置取值，避免 sqlite3.Row 的按名查找开销
+        patients = [
+            PatientInfo(hospital_id, cancer_type, sex, source_db)
+            for hospital_id, cancer_type, sex in cursor
+        ]
         conn.close()
     except Exception as e:
         raise Exception(f"Failed to read patients from {db_path}: {e}")
@@ -178,68 +174,129 @@ def _read_patients_from_db(db_path: Path) -> List[PatientInfo]:
     return patients
 
 
+# 一次最多附加的源数据库数量（SQLite 默认 SQLITE_MAX_ATTACHED 为 10）
+_MAX_ATTACHED = 10
+
+# 需要预估记录数的关联表
+_RELATED_TABLES = ['Surgery', 'Pathology', 'Molecular', 'FollowUpEvent']
+
+# 源库别名固定为 s0..s9，按别名预先生成语句，使每批源库复用同样的 SQL 文本
+_SOURCE_ALIASES = [f"s{i}" for i in range(_MAX_ATTACHED)]
+_ATTACH_SQL = {alias: f"ATTACH DATABASE ? AS {alias}" for alias in _SOURCE_ALIASES}
+_DETACH_SQL = {alias: f"DETACH DATABASE {alias}" for alias in _SOURCE_ALIASES}
+_LIST_TABLES_SQL = {
+    alias: f"SELECT name FROM {alias}.sqlite_master WHERE type='table'"
+    for alias in _SOURCE_ALIASES
+}
+_RESOLVE_PIDS_SQL = {
+    alias: (
+        f"INSERT OR IGNORE INTO temp.new_pids (src, patient_id) "
+        f"SELECT '{alias}', patient_id FROM {alias}.Patient "
+        f"WHERE hospital_id IN (SELECT hid FROM temp.new_ids WHERE src = ?)"
+    )
+    for alias in _SOURCE_ALIASES
+}
+_COUNT_SQL = {
+    (alias, table): (
+        f"SELECT COUNT(*) AS c FROM {alias}.{table} "
+        f"WHERE patient_id IN (SELECT patient_id FROM temp.new_pids WHERE src = '{alias}')"
+    )
+    for alias in _SOURCE_ALIASES
+    for table in _RELATED_TABLES
+}
+
+
+def _read_patients_from_db_safe(
+    db_path: Path
+) -> Tuple[Path, Optional[List[PatientInfo]], Optional[Exception]]:
+    """线程池使用的包装：返回 (路径, 患者列表, 异常)，不向外抛出异常"""
+    try:
+        return db_path, _read_patients_from_db(db_path), None
+    except Exception as e:
+        return db_path, None, e
+
+
 def _estimate_related_records(
-    source_paths: List[Path],
-    new_patients: List[PatientInfo]
+    new_ids_by_source: Dict[Path, Set[str]]
 ) -> Dict[str, int]:
-    """预估将要导入的关联记录数量"""
-    stats = {
-        'Surgery': 0,
-        'Pathology': 0,
-        'Molecular': 0,
-        'FollowUpEvent': 0
-    }
+    """预估将要导入的关联记录数量
+
+    Args:
+        new_ids_by_source: 源文件路径 -> 该文件中将被导入的新患者 hospital_id
+
+    将所有源库以只读方式 ATTACH 到同一个内存连接上。新患者的 hospital_id
+    只写入一次临时表，每个源库中对应的 patient_id 也只解析一次并物化到
+    临时表中；之后每张关联表只执行一条 UNION ALL 汇总查询，而不是逐个源库、
+    逐张表地重复绑定整批参数。
+    """
+    stats = {table: 0 for table in _RELATED_TABLES}
     
-    # 建立新患者的 hospital_id 集合
-    new_hospital_ids = {p.hospital_id for p in new_patients}
+    source_paths = [path for path, ids in new_ids_by_source.items() if ids]
+    if not source_paths:
+        return stats
     
-    for source_path in source_paths:
-        try:
-            conn = sqlite3.connect(source_path)
-            conn.row_factory = sqlite3.Row
-            
-            # 获取这些新患者在源库中的 patient_id
-            placeholders = ','.join('?' * len(new_hospital_ids))
-            cursor = conn.execute(
-                f"SELECT patient_id FROM Patient WHERE hospital_id IN ({placeholders})",
-                list(new_hospital_ids)
-            )
-            source_patient_ids = [row[0] for row in cursor]
-            
-            if not source_patient_ids:
-                conn.close()
-                continue
-            
-            # 统计各表的记录数
-            id_placeholders = ','.join('?' * len(source_patient_ids))
-            
-            for table in ['Surgery', 'Pathology', 'Molecular']:
+    conn = sqlite3.connect(":memory:", uri=True)
+    try:
+        # 以源文件序号区分各源库的新患者 hospital_id
+        conn.execute("CREATE TEMP TABLE new_ids (src INTEGER, hid TEXT, PRIMARY KEY (src, hid))")
+        # 每个源库中新患者的 patient_id，按源库别名分组，四张表的统计共用
+        conn.execute(
+            "CREATE TEMP TABLE new_pids (src TEXT, patient_id INTEGER, PRIMARY KEY (src, patient_id))"
+        )
+        conn.executemany(
+            "INSERT INTO new_ids (src, hid) VALUES (?, ?)",
+            ((idx, hid) for idx, path in enumerate(source_paths) for hid in new_ids_by_source[path]),
+        )
+        conn.commit()  # ATTACH/DETACH 不能在事务中执行
+        
+        for start in range(0, len(source_paths), _MAX_ATTACHED):
+            # 附加本批源库，并记录每个源库实际存在的表
+            schemas: Dict[str, Set[str]] = {}
+            sources: Dict[str, Path] = {}  # 已成功附加的别名 -> 源文件
+            src_index: Dict[str, int] = {}  # 别名 -> new_ids 中的源文件序号
+            batch = source_paths[start:start + _MAX_ATTACHED]
+            for i, (alias, source_path) in enumerate(zip(_SOURCE_ALIASES, batch)):
+                src_index[alias] = start + i
                 try:
-                    cursor = conn.execute(
-                        f"SELECT COUNT(*) FROM {table} WHERE patient_id IN ({id_placeholders})",
-                        source_patient_ids
-                    )
-                    count = cursor.fetchone()[0]
-                    stats[table] += count
-                except:
-                    pass
+                    uri = Path(source_path).resolve().as_uri() + "?mode=ro"
+                    conn.execute(_ATTACH_SQL[alias], (uri,))
+                    sources[alias] = source_path
+                    schemas[alias] = {row[0] for row in conn.execute(_LIST_TABLES_SQL[alias])}
+                    if 'Patient' not in schemas[alias]:
+                        raise Exception("no such table: Patient")
+                except Exception as e:
+                    schemas.pop(alias, None)
+                    print(f"Warning: Failed to estimate records from {source_path}: {e}")
             
-            # 随访事件
             try:
-                cursor = conn.execute(
-                    f"SELECT COUNT(*) FROM FollowUpEvent WHERE patient_id IN ({id_placeholders})",
-                    source_patient_ids
-                )
-                count = cursor.fetchone()[0]
-                stats['FollowUpEvent'] += count
-            except:
-                pass
-            
-            conn.close()
-            
-        except Exception as e:
-            print(f"Warning: Failed to estimate records from {source_path}: {e}")
-            continue
+                # 每个源库只解析一次 hospital_id -> patient_id
+                for alias in list(schemas):
+                    try:
+                        conn.execute(_RESOLVE_PIDS_SQL[alias], (src_index[alias],))
+                    except Exception as e:
+                        del schemas[alias]
+                        print(f"Warning: Failed to estimate records from {sources[alias]}: {e}")
+                
+                for table in _RELATED_TABLES:
+                    parts = [
+                        _COUNT_SQL[alias, table]
+                        for alias, tables in schemas.items()
+                        if table in tables
+                    ]
+                    if not parts:
+                        continue
+                    sql = "SELECT COALESCE(SUM(c), 0) FROM (\n" + "\nUNION ALL\n".join(parts) + "\n)"
+                    try:
+                        stats[table] += conn.execute(sql).fetchone()[0]
+                    except Exception as e:
+                        print(f"Warning: Failed to estimate {table} records: {e}")
+            finally:
+                conn.execute("DELETE FROM temp.new_pids")
+                conn.commit()
+                for alias in sources:
+                    conn.execute(_DETACH_SQL[alias])
+    finally:
+        conn.close()
     
     return stats
 
@@ -10,9 +10,12 @@ sequence of file paths.  It handles opening each source file, reading
 patients, and copying records using the Database API.  Basic error handling
 and logging is provided to help trace failures during the merge process.
 
-Note: Transactions are not explicitly managed here because the Database
-API commits after each insert.  If improved performance is desired in the
-future, consider exposing batch insert operations on the Database class.
+Each source file is merged inside a single transaction.  Where possible
+the source is ``ATTACH``-ed to the destination connection and child records
+are copied with one ``INSERT ... SELECT`` per table, keeping the copy inside
+SQLite.  If that fast path fails (e.g. an old source schema or a duplicate
+event code) the table falls back to reading rows in Python and writing them
+in batches through the Database ``insert_many_*`` methods.
 """
 
 from __future__ import annotations
@@ -20,9 +23,9 @@ from __future__ import annotations
 import logging
 import sqlite3
 from pathlib import Path
-from typing import Dict, Iterable, List, Optional
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
 
-from .models import Database
+from .models import Database, open_source_db
 
 # Configure a module‑level logger.  Logs will be written to ``importer.log``
 # in the working directory.  If no handlers are present, add a basic one.
@@ -38,6 +41,184 @@ if not logger.handlers:
     logger.addHandler(fh)
 
 
+# SQLite's default SQLITE_MAX_VARIABLE_NUMBER for builds before 3.32.
+_MAX_SQL_VARIABLES = 999
+
+
+def _iter_child_rows(
+    src_conn: sqlite3.Connection,
+    table: str,
+    columns: List[str],
+    src_ids: List[int],
+) -> Iterable[Tuple[Any, ...]]:
+    """Yield ``(patient_id, *columns)`` rows of ``table`` for any of ``src_ids``.
+
+    Issues one ``IN (...)`` query per batch of ids instead of one query per
+    patient, keeping each batch under SQLite's bound-parameter limit.
+    """
+    select_list = ", ".join(["patient_id", *columns])
+    for start in range(0, len(src_ids), _MAX_SQL_VARIABLES):
+        chunk = src_ids[start:start + _MAX_SQL_VARIABLES]
+        placeholders = ",".join("?" * len(chunk))
+        yield from src_conn.execute(
+            f"SELECT {select_list} FROM {table} WHERE patient_id IN ({placeholders})",
+            chunk,
+        )
+
+
+def _shared_columns(conn: sqlite3.Connection, table: str, dest_columns: List[str]) -> List[str]:
+    """Return the ``dest_columns`` that ``table`` on ``conn`` also has.
+
+    ``table`` may be schema-qualified (``src.Surgery``).  Older source files
+    can lack recently added columns; those are left to their defaults.
+    """
+    schema, _, name = table.rpartition(".")
+    pragma = f"PRAGMA {schema}.table_info({name})" if schema else f"PRAGMA table_info({name})"
+    src_cols = {row[1] for row in conn.execute(pragma)}
+    return [c for c in dest_columns if c in src_cols]
+
+
+def _insert_batch(
+    db: Database,
+    label: str,
+    rows: List[Dict[str, Any]],
+    insert_many: Callable[..., int],
+    insert_one: Callable[[Dict[str, Any]], Any],
+) -> int:
+    """Insert ``rows`` with one ``executemany``; fall back to row by row on error.
+
+    The batch runs under a savepoint so a single bad row (e.g. a duplicate
+    event code) only costs a retry of that batch instead of aborting the
+    surrounding import transaction.  Returns the number of rows inserted.
+    """
+    if not rows:
+        return 0
+    db.conn.execute("SAVEPOINT import_batch")
+    try:
+        count = insert_many(rows, commit=False)
+        db.conn.execute("RELEASE SAVEPOINT import_batch")
+        return count
+    except Exception as e:
+        db.conn.execute("ROLLBACK TO SAVEPOINT import_batch")
+        db.conn.execute("RELEASE SAVEPOINT import_batch")
+        logger.warning(f"Batch insert of {label} rows failed ({e}); retrying row by row")
+    count = 0
+    for row in rows:
+        try:
+            insert_one(row)
+            count += 1
+        except Exception as ie:
+            logger.error(f"Failed to insert {label} for patient {row.get('patient_id')}: {ie}")
+    return count
+
+
+# Replacement values for NULL columns, applied by both copy paths.
+_NULL_DEFAULTS = {
+    "FollowUpEvent": {"event_details": ""},
+}
+
+# Columns where an empty string means "missing".  The attached copy reads
+# them as NULL so the NOT NULL constraint sends the table to the row copy,
+# which generates the value.
+_EMPTY_AS_NULL = {
+    "FollowUpEvent": {"event_code"},
+}
+
+
+def _attach_source(db: Database, src_path: Path) -> bool:
+    """Attach ``src_path`` to the destination connection as schema ``src``."""
+    try:
+        db.conn.execute("ATTACH DATABASE ? AS src", (str(src_path),))
+        return True
+    except Exception as e:
+        logger.warning(f"Could not attach {src_path} ({e}); using row-by-row copy")
+        return False
+
+
+def _detach_source(db: Database) -> None:
+    try:
+        db.conn.execute("DETACH DATABASE src")
+    except Exception as e:
+        logger.warning(f"Failed to detach source database: {e}")
+
+
+def _copy_attached(db: Database, table: str, dest_columns: List[str]) -> Optional[int]:
+    """Copy ``table`` rows of mapped patients from ``src`` with ``INSERT ... SELECT``.
+
+    Only columns present in both schemas are copied and ``patient_id`` is
+    rewritten through ``temp._import_id_map``.  Returns the number of rows
+    copied, or ``None`` if the statement failed and nothing was written.
+    """
+    columns = _shared_columns(db.conn, f"src.{table}", dest_columns)
+    if not columns:
+        return None
+    defaults = _NULL_DEFAULTS.get(table, {})
+    empty_as_null = _EMPTY_AS_NULL.get(table, set())
+    exprs = [
+        f"COALESCE(s.{c}, :{c})" if c in defaults
+        else f"NULLIF(s.{c}, '')" if c in empty_as_null
+        else f"s.{c}"
+        for c in columns
+    ]
+    sql = (
+        f"INSERT INTO main.{table} (patient_id, {', '.join(columns)}) "
+        f"SELECT m.dest_pid, {', '.join(exprs)} FROM src.{table} s "
+        f"JOIN temp._import_id_map m ON s.patient_id = m.src_pid"
+    )
+    db.conn.execute("SAVEPOINT import_copy")
+    try:
+        count = db.conn.execute(sql, defaults).rowcount
+        db.conn.execute("RELEASE SAVEPOINT import_copy")
+        return count
+    except Exception as e:
+        db.conn.execute("ROLLBACK TO SAVEPOINT import_copy")
+        db.conn.execute("RELEASE SAVEPOINT import_copy")
+        logger.warning(f"Direct copy of {table} failed ({e}); falling back to row copy")
+        return None
+
+
+def _copy_child(
+    db: Database,
+    src_conn: sqlite3.Connection,
+    src_path: Path,
+    id_map: Dict[int, int],
+    table: str,
+    dest_columns: List[str],
+    insert_many: Callable[..., int],
+    insert_one: Callable[[Dict[str, Any]], Any],
+    attached: bool,
+) -> int:
+    """Copy all ``table`` rows of the mapped patients into the destination.
+
+    ``dest_columns`` lists the destination columns to fill, excluding the
+    primary key and ``patient_id``.  Tries the attached ``INSERT ... SELECT``
+    path first and otherwise reads the rows in Python and writes them with
+    ``insert_many``/``insert_one``.  Returns the number of rows imported.
+    """
+    if attached:
+        copied = _copy_attached(db, table, dest_columns)
+        if copied is not None:
+            return copied
+    defaults = _NULL_DEFAULTS.get(table, {})
+    try:
+        columns = _shared_columns(src_conn, table, dest_columns)
+        if not columns:
+            raise sqlite3.OperationalError(f"no such table: {table}")
+        rows = []
+        for row in _iter_child_rows(src_conn, table, columns, list(id_map)):
+            # Named columns: row[0] is patient_id, the rest follow ``columns``
+            data = dict(zip(columns, row[1:]))
+            for col, default in defaults.items():
+                if data.get(col) is None:
+                    data[col] = default
+            data["patient_id"] = id_map[row[0]]
+            rows.append(data)
+        return _insert_batch(db, table, rows, insert_many, insert_one)
+    except Exception as e:
+        logger.error(f"Error reading {table} rows from {src_path}: {e}")
+        return 0
+
+
 def import_databases(db: Database, source_paths: Iterable[str | Path]) -> Dict[str, int]:
     """Merge patient data from multiple SQLite databases into the destination.
 
@@ -70,17 +251,49 @@ def import_databases(db: Database, source_paths: Iterable[str | Path]) -> Dict[s
 
     # Build a set of existing hospital_ids from the destination DB once.  Use
     # ``row[0]`` instead of ``row['hospital_id']`` for speed since the
-    # destination cursor returns simple tuples by default.
+    # destination cursor returns simple tuples by default, and iterate the
+    # cursor directly rather than materialising the result with fetchall().
     try:
-        dest_hospital_ids = set(
+        dest_hospital_ids = {
             row[0]
-            for row in db.conn.execute("SELECT hospital_id FROM Patient").fetchall()
+            for row in db.conn.execute("SELECT hospital_id FROM Patient")
             if row[0]
-        )
+        }
     except Exception as e:
         logger.error(f"Failed to read destination hospital IDs: {e}")
         raise
 
+    # Child tables copied for each new patient: (table, primary key,
+    # batch insert, single-row insert used when the batch fails).
+    child_tables = (
+        ("Surgery", "surgery_id", db.insert_many_surgery,
+         lambda r: db.insert_surgery(r["patient_id"], r, commit=False)),
+        ("Pathology", "path_id", db.insert_many_pathology,
+         lambda r: db.insert_pathology(r["patient_id"], r, commit=False)),
+        ("Molecular", "mol_id", db.insert_many_molecular,
+         lambda r: db.insert_molecular(r["patient_id"], r, commit=False)),
+        ("FollowUpEvent", "event_id", db.insert_many_followup_events,
+         lambda r: db.insert_followup_event(
+             r["patient_id"], r.get("event_date"), r.get("event_type"),
+             r.get("event_details") or "", r.get("event_code"), commit=False,
+         )),
+    )
+
+    # Destination columns to copy per table (all but the keys).
+    patient_columns = [c for c in db.get_columns("Patient") if c != "patient_id"]
+    dest_columns = {
+        table: [c for c in db.get_columns(table) if c not in (pk, "patient_id")]
+        for table, pk, _, _ in child_tables
+    }
+
+    # Scratch table mapping source patient_id -> destination patient_id for
+    # the INSERT ... SELECT fast path.
+    db.conn.execute(
+        "CREATE TEMP TABLE IF NOT EXISTS _import_id_map "
+        "(src_pid INTEGER PRIMARY KEY, dest_pid INTEGER NOT NULL)"
+    )
+    db.conn.commit()
+
     for path in source_paths:
         try:
             # Accept both string and Path objects
@@ -89,30 +302,40 @@ def import_databases(db: Database, source_paths: Iterable[str | Path]) -> Dict[s
                 logger.warning(f"Source file {src_path} does not exist or is not a file; skipping")
                 continue
             logger.info(f"Importing from {src_path}")
-            src_conn = sqlite3.connect(src_path)
-            src_conn.row_factory = sqlite3.Row
+            src_conn = open_source_db(src_path)
         except Exception as e:
             logger.error(f"Unable to open {path}: {e}")
             continue
 
+        # ATTACH is not allowed inside a transaction, so attach first and
+        # then merge this source in a single transaction.
+        attached = _attach_source(db, src_path)
+        if not db.conn.in_transaction:
+            db.conn.execute("BEGIN IMMEDIATE")
+
         # Mapping from src patient_id to dest patient_id for patients newly
         # inserted from this source.  Used to associate child records.
         id_map: Dict[int, int] = {}
         try:
-            # Fetch all patients from the source
-            cur_pat = src_conn.execute("SELECT * FROM Patient")
+            # Fetch all patients from the source as plain tuples of
+            # (patient_id, *patient_columns).
+            columns = _shared_columns(src_conn, "Patient", patient_columns)
+            hid_pos = columns.index("hospital_id")
+            cur_pat = src_conn.execute(
+                f"SELECT patient_id, {', '.join(columns)} FROM Patient"
+            )
             for row in cur_pat:
-                hospital_id = row["hospital_id"]
+                src_pid, values = row[0], row[1:]
+                hospital_id = values[hid_pos]
                 if not hospital_id:
                     continue
                 if hospital_id in dest_hospital_ids:
                     # Skip patients already present in destination
                     continue
-                # Build a dict of patient fields excluding the primary key.
-                patient_data = {k: row[k] for k in row.keys() if k != "patient_id"}
+                patient_data = dict(zip(columns, values))
                 try:
-                    new_pid = db.insert_patient(patient_data)
-                    id_map[row["patient_id"]] = new_pid
+                    new_pid = db.insert_patient(patient_data, commit=False)
+                    id_map[src_pid] = new_pid
                     dest_hospital_ids.add(hospital_id)
                     stats["Patient"] += 1
                 except Exception as ie:
@@ -123,97 +346,33 @@ def import_databases(db: Database, source_paths: Iterable[str | Path]) -> Dict[s
             # If no new patients were inserted, skip copying child tables
             if not id_map:
                 logger.info(f"No new patients found in {src_path}; skipping child tables")
-                src_conn.close()
-                continue
-
-            # Import surgeries
-            for src_pid, dest_pid in id_map.items():
-                try:
-                    s_cur = src_conn.execute(
-                        "SELECT * FROM Surgery WHERE patient_id = ?",
-                        (src_pid,),
-                    )
-                    for srow in s_cur:
-                        # Build data dictionary excluding primary and foreign keys
-                        data = {k: srow[k] for k in srow.keys() if k not in ("surgery_id", "patient_id")}
-                        try:
-                            db.insert_surgery(dest_pid, data)
-                            stats["Surgery"] += 1
-                        except Exception as se:
-                            logger.error(
-                                f"Failed to insert surgery for patient {dest_pid} (src {src_pid}): {se}"
-                            )
-                except Exception as e:
-                    logger.error(f"Error reading surgeries from {src_path}: {e}")
-
-            # Import pathology
-            for src_pid, dest_pid in id_map.items():
-                try:
-                    p_cur = src_conn.execute(
-                        "SELECT * FROM Pathology WHERE patient_id = ?",
-                        (src_pid,),
+            else:
+                if attached:
+                    db.conn.execute("DELETE FROM temp._import_id_map")
+                    db.conn.executemany(
+                        "INSERT INTO temp._import_id_map (src_pid, dest_pid) VALUES (?, ?)",
+                        id_map.items(),
                     )
-                    for prow in p_cur:
-                        data = {k: prow[k] for k in prow.keys() if k not in ("path_id", "patient_id")}
-                        try:
-                            db.insert_pathology(dest_pid, data)
-                            stats["Pathology"] += 1
-                        except Exception as pe:
-                            logger.error(
-                                f"Failed to insert pathology for patient {dest_pid} (src {src_pid}): {pe}"
-                            )
-                except Exception as e:
-                    logger.error(f"Error reading pathology from {src_path}: {e}")
-
-            # Import molecular
-            for src_pid, dest_pid in id_map.items():
-                try:
-                    m_cur = src_conn.execute(
-                        "SELECT * FROM Molecular WHERE patient_id = ?",
-                        (src_pid,),
-                    )
-                    for mrow in m_cur:
-                        data = {k: mrow[k] for k in mrow.keys() if k not in ("mol_id", "patient_id")}
-                        try:
-                            db.insert_molecular(dest_pid, data)
-                            stats["Molecular"] += 1
-                        except Exception as me:
-                            logger.error(
-                                f"Failed to insert molecular for patient {dest_pid} (src {src_pid}): {me}"
-                            )
-                except Exception as e:
-                    logger.error(f"Error reading molecular from {src_path}: {e}")
-
-            # Import follow-up events
-            for src_pid, dest_pid in id_map.items():
-                try:
-                    fu_cur = src_conn.execute(
-                        "SELECT * FROM FollowUpEvent WHERE patient_id = ?",
-                        (src_pid,),
+
+                for table, _, insert_many, insert_one in child_tables:
+                    stats[table] += _copy_child(
+                        db, src_conn, src_path, id_map, table, dest_columns[table],
+                        insert_many, insert_one, attached,
                     )
-                    for evrow in fu_cur:
-                        # Extract event details; evrow is a sqlite3.Row
-                        ev_dict = dict(evrow)
-                        event_date = ev_dict.get("event_date")
-                        event_type = ev_dict.get("event_type")
-                        event_details = ev_dict.get("event_details") or ""
-                        event_code = ev_dict.get("event_code")
-                        try:
-                            db.insert_followup_event(dest_pid, event_date, event_type, event_details, event_code)
-                            stats["FollowUpEvent"] += 1
-                        except Exception as fe:
-                            logger.error(
-                                f"Failed to insert follow-up event for patient {dest_pid} (src {src_pid}): {fe}"
-                            )
-                except Exception as e:
-                    logger.error(f"Error reading follow-up events from {src_path}: {e}")
 
+            db.conn.commit()
         except Exception as e:
             logger.error(f"Unexpected error importing from {path}: {e}")
+            db.conn.commit()
+        except BaseException:
+            db.conn.rollback()
+            raise
         finally:
             try:
                 src_conn.close()
             except Exception:
                 pass
+            if attached:
+                _detach_source(db)
 
     return stats
\ No newline at end of file
@@ -8,142 +8,243 @@
 import random
 import sqlite3
 import string
+from collections import defaultdict
 from pathlib import Path
 
+# 当前数据库结构版本，记录在 PRAGMA user_version 中；
+# 修改建表语句或新增迁移步骤时需递增
+SCHEMA_VERSION = 15
+
+# 迁移涉及的表，及其预先拼好的 PRAGMA 语句
+MIGRATED_TABLES = ("Patient", "Pathology", "Molecular", "Surgery", "FollowUpEvent")
+_TABLE_INFO_SQL = {table: f"PRAGMA table_info({table})" for table in MIGRATED_TABLES}
+
 def get_table_columns(conn, table_name):
     """获取表的所有列名"""
-    cursor = conn.execute(f"PRAGMA table_info({table_name})")
+    sql = _TABLE_INFO_SQL.get(table_name) or f"PRAGMA table_info({table_name})"
+    cursor = conn.execute(sql)
     return {row[1] for row in cursor.fetchall()}
 
-def add_column_if_not_exists(conn, table_name, column_name, column_type, default=None):
-    """如果列不存在则添加"""
-    existing_columns = get_table_columns(conn, table_name)
+# 各表在历次版本中新增的字段：(列名, 类型, 默认值)
+COLUMN_MIGRATIONS = {
+    "Patient": [
+        ("eso_from_incisors_cm", "REAL", None),
+        # 家族恶性肿瘤史
+        ("diabetes_history", "INTEGER", 0),
+        ("family_history", "INTEGER", 0),
+        # 新辅助及辅助放疗，默认值为0
+        ("nac_radiation", "INTEGER", 0),
+        ("adj_radiation", "INTEGER", 0),
+        # 新辅助和辅助治疗日期 (v2.12)
+        ("nac_date", "TEXT", None),
+        ("adj_date", "TEXT", None),
+        # 抗血管治疗 (v2.13)
+        ("nac_antiangio", "INTEGER", 0),
+        ("nac_antiangio_cycles", "INTEGER", None),
+        ("adj_antiangio", "INTEGER", 0),
+        ("adj_antiangio_cycles", "INTEGER", None),
+    ],
+    "Pathology": [
+        ("airway_spread", "INTEGER", None),
+        ("pathology_no", "TEXT", None),
+        # 肺腺癌主要亚型
+        ("aden_subtype", "TEXT", None),
+        # 病理日期 (v2.13)
+        ("pathology_date", "TEXT", None),
+    ],
+    "Molecular": [
+        ("ctc_count", "INTEGER", None),
+        ("methylation_result", "TEXT", None),
+    ],
+    # 左右打勾框
+    "Surgery": [
+        ("left_side", "INTEGER", 0),
+        ("right_side", "INTEGER", 0),
+    ],
+}
+
+def read_schema(conn, table_names):
+    """一次查询读取多张表的列名，返回 {表名: 列名集合}（不存在的表不包含在内）"""
+    placeholders = ",".join("?" * len(table_names))
+    cursor = conn.execute(
+        "SELECT m.name, p.name FROM sqlite_master AS m, pragma_table_info(m.name) AS p "
+        f"WHERE m.type = 'table' AND m.name IN ({placeholders})",
+        tuple(table_names),
+    )
+    schema = {}
+    for table_name, column_name in cursor:
+        schema.setdefault(table_name, set()).add(column_name)
+    return schema
+
+def add_column_if_not_exists(conn, schema, table_name, column_name, column_type, default=None):
+    """如果列不存在则添加；schema 为 {表名: 列名集合} 缓存，添加后同步更新"""
+    existing_columns = schema[table_name]
     if column_name not in existing_columns:
         default_clause = f" DEFAULT {default}" if default is not None else ""
         sql = f"ALTER TABLE {table_name} ADD COLUMN {column_name} {column_type}{default_clause}"
         print(f"添加字段: {table_name}.{column_name}")
         conn.execute(sql)
-        conn.commit()
+        existing_columns.add(column_name)
         return True
     return False
 
 
-def generate_unique_event_code(conn, patient_id: int, length: int = 6) -> str:
-    """Ϊ指定患者生成唯一的随访事件编号"""
+def generate_unique_event_code(used_codes: set, length: int = 6, max_attempts: int = 100) -> str:
+    """生成不在 used_codes 中的随机数字编号，并将其加入 used_codes
+
+    每种长度最多尝试 max_attempts 次；仍然冲突时（该长度的编号已接近用尽）
+    改为生成长一位的编号，因此总能在有限次尝试内返回。
+    """
     digits = string.digits
     while True:
-        candidate = "".join(random.choices(digits, k=length))
-        exists = conn.execute(
-            "SELECT 1 FROM FollowUpEvent WHERE patient_id=? AND event_code=?",
-            (patient_id, candidate),
-        ).fetchone()
-        if not exists:
-            return candidate
-
-def migrate_database(db_path):
-    """执行数据库迁移"""
+        for _ in range(max_attempts):
+            candidate = "".join(random.choices(digits, k=length))
+            if candidate not in used_codes:
+                used_codes.add(candidate)
+                return candidate
+        length += 1
+
+def backfill_event_codes(conn, rows, max_attempts=3):
+    """为 (event_id, patient_id) 列表批量分配编号
+
+    各患者已占用的编号一次性读入内存后在本地分配，再用一条 executemany 写回；
+    唯一索引尚未建立时也不会分配重复编号。若写回时触发唯一索引冲突
+    （例如编号被并发写入），回滚本批并重新分配。
+    """
+    for attempt in range(max_attempts):
+        used = defaultdict(set)
+        for patient_id, event_code in conn.execute(
+            "SELECT patient_id, event_code FROM FollowUpEvent WHERE event_code IS NOT NULL AND event_code != ''"
+        ):
+            used[patient_id].add(event_code)
+        updates = [
+            (generate_unique_event_code(used[patient_id]), event_id)
+            for event_id, patient_id in rows
+        ]
+        conn.execute("SAVEPOINT backfill_event_codes")
+        try:
+            conn.executemany("UPDATE FollowUpEvent SET event_code=? WHERE event_id=?", updates)
+        except sqlite3.IntegrityError:
+            conn.execute("ROLLBACK TO backfill_event_codes")
+            conn.execute("RELEASE backfill_event_codes")
+            if attempt == max_attempts - 1:
+                raise
+            continue
+        conn.execute("RELEASE backfill_event_codes")
+        return
+
+def split_sql_script(script):
+    """把多条语句的 SQL 脚本拆分为单条语句，以便在同一事务中逐条执行
+
+    executescript 会先提交当前事务，不能用于迁移事务内部；
+    按 sqlite3.complete_statement 判断语句边界，触发器等含分号的语句也能正确拆分。
+    """
+    statements = []
+    pending = ""
+    for line in script.splitlines(keepends=True):
+        pending += line
+        if sqlite3.complete_statement(pending):
+            statements.append(pending.strip())
+            pending = ""
+    if pending.strip():
+        statements.append(pending.strip())
+    return statements
+
+def migrate_database(db, schema_sql=None):
+    """执行数据库迁移
+
+    db 可以是数据库路径，也可以是已打开的连接（如 Database.conn）；
+    传入连接时沿用该连接且不关闭它，避免启动时重复打开数据库。
+
+    schema_sql 为完整建表脚本（Database 传入 _SCHEMA_SQL）：补齐字段后在同一事务中
+    执行该脚本，全部成功后才写入 PRAGMA user_version。未提供时只补齐已有表的字段，
+    不写入结构版本，避免在缺少表或索引的情况下把数据库标记为最新。
+    """
+    owns_conn = not isinstance(db, sqlite3.Connection)
+    conn = sqlite3.connect(db) if owns_conn else db
+    db_path = db if owns_conn else conn.execute("PRAGMA database_list").fetchone()[2]
     print(f"开始迁移数据库: {db_path}")
-    conn = sqlite3.connect(db_path)
+    # 结构版本已是最新时无需读取任何表结构
+    if conn.execute("PRAGMA user_version").fetchone()[0] >= SCHEMA_VERSION:
+        if owns_conn:
+            conn.close()
+        print("- 无需迁移")
+        return False
     conn.execute("PRAGMA foreign_keys = ON;")
+    conn.execute("PRAGMA journal_mode = WAL;")
+    conn.execute("PRAGMA synchronous = NORMAL;")
+    conn.execute("PRAGMA temp_store = MEMORY;")
     
-    changes_made = False
-    
-    # Patient表新增字段
-    if add_column_if_not_exists(conn, "Patient", "eso_from_incisors_cm", "REAL"):
-        changes_made = True
-
-    # Patient表新增: 家族恶性肿瘤史
-    if add_column_if_not_exists(conn, "Patient", "diabetes_history", "INTEGER", default=0):
-        changes_made = True
-    if add_column_if_not_exists(conn, "Patient", "family_history", "INTEGER", default=0):
-        changes_made = True
-
-    # Patient表新增: 新辅助及辅助放疗
-    # 新增新辅助放疗和辅助放疗字段，默认值为0
-    if add_column_if_not_exists(conn, "Patient", "nac_radiation", "INTEGER", default=0):
-        changes_made = True
-    if add_column_if_not_exists(conn, "Patient", "adj_radiation", "INTEGER", default=0):
-        changes_made = True
-    
-    # Patient表新增: 新辅助和辅助治疗日期 (v2.12)
-    if add_column_if_not_exists(conn, "Patient", "nac_date", "TEXT"):
-        changes_made = True
-    if add_column_if_not_exists(conn, "Patient", "adj_date", "TEXT"):
-        changes_made = True
+    # 所有 ALTER/UPDATE 合并到同一事务中，只在结束时提交一次；
+    # IMMEDIATE 在开始时即取得写锁，避免迁移中途因其他连接占用而失败
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        changes_made = False
     
-    # Patient表新增: 抗血管治疗 (v2.13)
-    if add_column_if_not_exists(conn, "Patient", "nac_antiangio", "INTEGER", default=0):
-        changes_made = True
-    if add_column_if_not_exists(conn, "Patient", "nac_antiangio_cycles", "INTEGER"):
-        changes_made = True
-    if add_column_if_not_exists(conn, "Patient", "adj_antiangio", "INTEGER", default=0):
-        changes_made = True
-    if add_column_if_not_exists(conn, "Patient", "adj_antiangio_cycles", "INTEGER"):
-        changes_made = True
+        # 一次性读取各表结构，后续字段检查均使用此缓存
+        schema = read_schema(conn, MIGRATED_TABLES)
     
-    # Pathology表修改
-    if add_column_if_not_exists(conn, "Pathology", "airway_spread", "INTEGER"):
-        changes_made = True
-    if add_column_if_not_exists(conn, "Pathology", "pathology_no", "TEXT"):
-        changes_made = True
-    # 新增: Pathology表添加肺腺癌主要亚型字段
-    if add_column_if_not_exists(conn, "Pathology", "aden_subtype", "TEXT"):
-        changes_made = True
-    # 新增: Pathology表添加病理日期字段 (v2.13)
-    if add_column_if_not_exists(conn, "Pathology", "pathology_date", "TEXT"):
-        changes_made = True
+        # 按表批量补齐缺失字段；没有缺失字段的表不执行任何语句，
+        # 尚不存在的表随后由 schema_sql 按完整结构创建
+        for table_name, columns in COLUMN_MIGRATIONS.items():
+            if table_name not in schema:
+                continue
+            missing = [c for c in columns if c[0] not in schema[table_name]]
+            for column_name, column_type, default in missing:
+                add_column_if_not_exists(conn, schema, table_name, column_name, column_type, default)
+            if missing:
+                changes_made = True
     
-    # Molecular表新增字段
-    if add_column_if_not_exists(conn, "Molecular", "ctc_count", "INTEGER"):
-        changes_made = True
-    if add_column_if_not_exists(conn, "Molecular", "methylation_result", "TEXT"):
-        changes_made = True
-    
-    # Surgery表新增字段: 左右打勾框
-    if add_column_if_not_exists(conn, "Surgery", "left_side", "INTEGER", default=0):
-        changes_made = True
-    if add_column_if_not_exists(conn, "Surgery", "right_side", "INTEGER", default=0):
-        changes_made = True
-    
-    # 创建FollowUpEvent表（v2.1新增）
-    cursor = conn.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='FollowUpEvent'")
-    if not cursor.fetchone():
-        print("创建新表: FollowUpEvent")
-        conn.execute("""
-            CREATE TABLE FollowUpEvent (
-                event_id INTEGER PRIMARY KEY AUTOINCREMENT,
-                patient_id INTEGER NOT NULL,
-                event_date TEXT NOT NULL,
-                event_type TEXT NOT NULL,
-                event_details TEXT,
-                event_code TEXT NOT NULL,
-                FOREIGN KEY (patient_id) REFERENCES Patient(patient_id) ON DELETE CASCADE
-            )
-        """)
-        conn.execute("CREATE INDEX idx_followup_event_patient_id ON FollowUpEvent(patient_id)")
-        conn.execute("CREATE INDEX idx_followup_event_date ON FollowUpEvent(event_date DESC)")
-        conn.execute("CREATE UNIQUE INDEX idx_followup_event_code ON FollowUpEvent(patient_id, event_code)")
-        conn.commit()
-        changes_made = True
-    else:
-        if add_column_if_not_exists(conn, "FollowUpEvent", "event_code", "TEXT"):
+        # 创建FollowUpEvent表（v2.1新增）
+        if "FollowUpEvent" not in schema:
+            print("创建新表: FollowUpEvent")
+            conn.execute("""
+                CREATE TABLE FollowUpEvent (
+                    event_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    patient_id INTEGER NOT NULL,
+                    event_date TEXT NOT NULL,
+                    event_type TEXT NOT NULL,
+                    event_details TEXT,
+                    event_code TEXT NOT NULL,
+                    FOREIGN KEY (patient_id) REFERENCES Patient(patient_id) ON DELETE CASCADE
+                )
+            """)
+            conn.execute("CREATE INDEX idx_fue_patient_date ON FollowUpEvent(patient_id, event_date DESC, event_id DESC)")
+            conn.execute("CREATE INDEX idx_followup_event_date ON FollowUpEvent(event_date DESC)")
+            conn.execute("CREATE UNIQUE INDEX idx_followup_event_code ON FollowUpEvent(patient_id, event_code)")
+            schema["FollowUpEvent"] = get_table_columns(conn, "FollowUpEvent")
             changes_made = True
+        else:
+            if add_column_if_not_exists(conn, schema, "FollowUpEvent", "event_code", "TEXT"):
+                changes_made = True
 
-    followup_columns = get_table_columns(conn, "FollowUpEvent")
-    if "event_code" in followup_columns:
-        cursor = conn.execute("SELECT event_id, patient_id FROM FollowUpEvent WHERE event_code IS NULL OR event_code = ''")
-        rows = cursor.fetchall()
-        if rows:
-            print("为 FollowUpEvent 补全随机编号...")
-            for event_id, patient_id in rows:
-                code = generate_unique_event_code(conn, patient_id)
-                conn.execute("UPDATE FollowUpEvent SET event_code=? WHERE event_id=?", (code, event_id))
-            conn.commit()
-            changes_made = True
-        conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_followup_event_code ON FollowUpEvent(patient_id, event_code)")
+        if "event_code" in schema["FollowUpEvent"]:
+            # 先为缺失编号（NULL 或空字符串）的记录补全编号，再建唯一索引；
+            # 空字符串编号会互相冲突，且 event_code 列可能为 NOT NULL，不能置为 NULL
+            cursor = conn.execute("SELECT event_id, patient_id FROM FollowUpEvent WHERE event_code IS NULL OR event_code = ''")
+            rows = cursor.fetchall()
+            if rows:
+                print("为 FollowUpEvent 补全随机编号...")
+                backfill_event_codes(conn, rows)
+                changes_made = True
+            cursor = conn.execute(
+                "SELECT 1 FROM sqlite_master WHERE type='index' AND name='idx_followup_event_code'"
+            )
+            if not cursor.fetchone():
+                conn.execute("CREATE UNIQUE INDEX idx_followup_event_code ON FollowUpEvent(patient_id, event_code)")
+        if schema_sql is not None:
+            # 已有表的字段补齐后再建表建索引，索引所需的列均已存在；
+            # 结构版本与建表语句在同一事务中提交
+            for statement in split_sql_script(schema_sql):
+                conn.execute(statement)
+            conn.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
         conn.commit()
-
-    conn.close()
+    except BaseException:
+        conn.rollback()
+        raise
+    finally:
+        if owns_conn:
+            conn.close()
     
     if changes_made:
         print("✓ 迁移完成")
@@ -153,5 +254,9 @@ def migrate_database(db_path):
     return changes_made
 
 if __name__ == "__main__":
-    db_path = Path(__file__).parent.parent / "thoracic.db"
-    migrate_database(db_path)
+    # 通过 Database 打开以完成迁移，保证建表语句与结构版本一并写入
+    import sys
+    sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+    from db.models import Database, DEFAULT_DB_PATH
+
+    Database(DEFAULT_DB_PATH).close()
@@ -10,17 +10,26 @@ pattern is used to abstract common CRUD operations.
 
 Note: SQLite will enforce referential integrity via foreign keys.  The
 ``PRAGMA foreign_keys = ON`` statement is executed on connection.
+
+The database is opened in WAL journal mode with ``synchronous = NORMAL``,
+so each commit costs a single append instead of two fsyncs.  While a
+connection is open SQLite keeps ``thoracic.db-wal`` and ``thoracic.db-shm``
+files next to the database; committed data may live in the ``-wal`` file
+until it is checkpointed, so copy the database only after calling
+:meth:`Database.checkpoint` (or after closing every connection).
 """
 
 from __future__ import annotations
 
-import random
+import queue
 import sqlite3
-import string
+from contextlib import contextmanager
 from dataclasses import dataclass, asdict
+from functools import lru_cache
 from pathlib import Path
-from typing import Any, Dict, List, Optional, Tuple, Iterable
+from typing import Any, Dict, List, Optional, Tuple, Iterable, Iterator
 
+from .migrate import SCHEMA_VERSION, generate_unique_event_code as _pick_event_code, migrate_database
 
 import sys
 
@@ -45,266 +54,365 @@ DEFAULT_DB_PATH = get_db_path()
 
 
 
+def open_source_db(path) -> sqlite3.Connection:
+    """Open a database that will only be read from (import sources, pre-checks).
+
+    The connection is marked query-only and given a larger page cache and
+    memory-mapped I/O, which speeds up the full-table scans done on import.
+    """
+    conn = sqlite3.connect(path)
+    conn.execute("PRAGMA query_only = 1;")
+    conn.execute("PRAGMA cache_size = -65536;")  # 64 MB
+    conn.execute("PRAGMA mmap_size = 268435456;")  # 256 MB
+    conn.execute("PRAGMA temp_store = MEMORY;")
+    return conn
+
+
+def open_ro_connection(path) -> sqlite3.Connection:
+    """Open a read-only connection to the database at ``path``.
+
+    The connection may be handed between threads, and is what
+    :meth:`Database.acquire_ro` pools; worker processes, which cannot share
+    a ``Database``, open their own readers with it directly.
+    """
+    uri = Path(path).resolve().as_uri() + "?mode=ro"
+    conn = sqlite3.connect(uri, uri=True, check_same_thread=False)
+    conn.execute("PRAGMA temp_store = MEMORY;")
+    conn.execute("PRAGMA mmap_size = 268435456;")  # 256 MB
+    conn.row_factory = sqlite3.Row
+    return conn
+
+
+def _column_key(data: Dict[str, Any]) -> Tuple[str, ...]:
+    """Cache key for a row's columns; sorted so dict order does not matter.
+
+    The generated statements use named placeholders, so the column order
+    inside the SQL is irrelevant to the values bound.
+    """
+    return tuple(sorted(data))
+
+
+@lru_cache(maxsize=256)
+def _insert_sql(table: str, columns: Tuple[str, ...]) -> str:
+    """Build (once per table and column tuple) an INSERT with named placeholders."""
+    return f"INSERT INTO {table} ({','.join(columns)}) VALUES (:{',:'.join(columns)})"
+
+
+@lru_cache(maxsize=256)
+def _update_sql(table: str, columns: Tuple[str, ...], key: str) -> str:
+    """Build (once per table and column tuple) an UPDATE keyed on ``key``."""
+    set_clause = ",".join(f"{c} = :{c}" for c in columns)
+    return f"UPDATE {table} SET {set_clause} WHERE {key} = :{key}"
+
+
+@lru_cache(maxsize=256)
+def _upsert_sql(table: str, columns: Tuple[str, ...], key: str) -> str:
+    """Build (once per table and column tuple) an INSERT ... ON CONFLICT(key) DO UPDATE."""
+    updates = [c for c in columns if c != key]
+    action = (
+        "DO UPDATE SET " + ",".join(f"{c} = excluded.{c}" for c in updates)
+        if updates else "DO NOTHING"
+    )
+    return f"{_insert_sql(table, columns)} ON CONFLICT({key}) {action}"
+
+
+def _select_list(columns: Optional[Tuple[str, ...]]) -> str:
+    """Return the SELECT list for ``columns``, or ``*`` when none are given."""
+    return ",".join(columns) if columns else "*"
+
+
 def row_to_dict(row):
     """将sqlite3.Row转换为字典"""
     if row is None:
         return None
     return dict(row)
 
+
+# Tables that export_table may read, each with its ready-made full-table query.
+_EXPORT_SQL = {
+    table: f"SELECT * FROM {table}"
+    for table in ("Patient", "Surgery", "Pathology", "Molecular", "FollowUp", "FollowUpEvent")
+}
+
+
+# Full schema for a new database: every table and index, all idempotent.
+# Applied by migrate_database inside its migration transaction, so the
+# schema version is only stamped once every statement has succeeded.
+_SCHEMA_SQL = """
+-- Patient table
+CREATE TABLE IF NOT EXISTS Patient (
+    patient_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    hospital_id TEXT UNIQUE,
+    cancer_type TEXT,
+    sex TEXT,
+    birth_ym4 TEXT,
+    pack_years REAL,
+    multi_primary INTEGER,
+    lung_t TEXT,
+    lung_n TEXT,
+    lung_m TEXT,
+    eso_t TEXT,
+    eso_n TEXT,
+    eso_m TEXT,
+    eso_histology TEXT,
+    eso_grade TEXT,
+    eso_location TEXT,
+    eso_from_incisors_cm REAL,
+    diabetes_history INTEGER DEFAULT 0,
+    family_history INTEGER DEFAULT 0,
+    nac_chemo INTEGER,
+    nac_chemo_cycles INTEGER,
+    nac_immuno INTEGER,
+    nac_immuno_cycles INTEGER,
+    nac_targeted INTEGER,
+    nac_targeted_cycles INTEGER,
+    -- 新增: 新辅助放疗勾选
+    nac_radiation INTEGER,
+    -- 新增: 新辅助抗血管治疗 (v2.13)
+    nac_antiangio INTEGER,
+    nac_antiangio_cycles INTEGER,
+    -- 新增: 新辅助治疗日期 (yymmdd格式)
+    nac_date TEXT,
+    adj_chemo INTEGER,
+    adj_chemo_cycles INTEGER,
+    adj_immuno INTEGER,
+    adj_immuno_cycles INTEGER,
+    adj_targeted INTEGER,
+    adj_targeted_cycles INTEGER,
+    -- 新增: 辅助放疗勾选
+    adj_radiation INTEGER,
+    -- 新增: 辅助抗血管治疗 (v2.13)
+    adj_antiangio INTEGER,
+    adj_antiangio_cycles INTEGER,
+    -- 新增: 辅助治疗日期 (yymmdd格式)
+    adj_date TEXT,
+    notes_patient TEXT
+);
+-- Index for cancer_type
+CREATE INDEX IF NOT EXISTS idx_patient_cancer_type ON Patient(cancer_type);
+
+-- Surgery table
+CREATE TABLE IF NOT EXISTS Surgery (
+    surgery_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    patient_id INTEGER,
+    cancer_type TEXT,
+    surgery_date6 TEXT,
+    indication TEXT,
+    planned INTEGER DEFAULT 1,
+    completed INTEGER DEFAULT 1,
+    start_hhmm INTEGER,
+    end_hhmm INTEGER,
+    duration_min INTEGER,
+    ln_dissection INTEGER DEFAULT 1,
+    r0 INTEGER DEFAULT 1,
+    -- Lung specific
+    approach TEXT,
+    scope_lung TEXT,
+    lobe TEXT,
+    left_side INTEGER DEFAULT 0,
+    right_side INTEGER DEFAULT 0,
+    bilateral INTEGER,
+    lesion_count INTEGER,
+    main_lesion_size_cm REAL,
+    -- Esophageal specific
+    esophagus_site TEXT,
+    notes_surgery TEXT,
+    FOREIGN KEY (patient_id) REFERENCES Patient(patient_id) ON DELETE CASCADE
+);
+-- Composite index matching get_surgeries_by_patient's filter and
+-- ordering; it also serves plain patient_id lookups.
+DROP INDEX IF EXISTS idx_surgery_patient_id;
+CREATE INDEX IF NOT EXISTS idx_surgery_patient_date ON Surgery(patient_id, surgery_date6 DESC);
+
+-- Pathology table
+CREATE TABLE IF NOT EXISTS Pathology (
+    path_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    patient_id INTEGER,
+    specimen_type TEXT,
+    histology TEXT,
+    differentiation TEXT,
+    pt TEXT,
+    pn TEXT,
+    pm TEXT,
+    p_stage TEXT,
+    lvi INTEGER,
+    pni INTEGER,
+    pleural_invasion INTEGER,
+    airway_spread INTEGER,
+    pathology_no TEXT,
+    -- 新增: 病理报告日期 (yymmdd格式)
+    pathology_date TEXT,
+    ln_total INTEGER,
+    ln_positive INTEGER,
+    trg INTEGER,
+    report_date TEXT,
+    notes_path TEXT,
+    -- 新增: 肺腺癌主要亚型
+    aden_subtype TEXT,
+    FOREIGN KEY (patient_id) REFERENCES Patient(patient_id) ON DELETE CASCADE
+);
+DROP INDEX IF EXISTS idx_path_patient_id;
+CREATE INDEX IF NOT EXISTS idx_path_patient_path ON Pathology(patient_id, path_id DESC);
+
+-- Molecular table
+CREATE TABLE IF NOT EXISTS Molecular (
+    mol_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    patient_id INTEGER,
+    platform TEXT,
+    vendor_lab TEXT,
+    gene TEXT,
+    variant TEXT,
+    pdl1_percent REAL,
+    tmb_msi TEXT,
+    test_date TEXT,
+    genes_tested TEXT,
+    result_summary TEXT,
+    ctc_count INTEGER,
+    methylation_result TEXT,
+    notes_mol TEXT,
+    FOREIGN KEY (patient_id) REFERENCES Patient(patient_id) ON DELETE CASCADE
+);
+DROP INDEX IF EXISTS idx_mol_patient_id;
+CREATE INDEX IF NOT EXISTS idx_mol_patient_date ON Molecular(patient_id, test_date DESC);
+
+-- FollowUp table (Legacy - kept for migration compatibility)
+CREATE TABLE IF NOT EXISTS FollowUp (
+    patient_id INTEGER PRIMARY KEY,
+    last_visit_date TEXT,
+    status TEXT,
+    death_date TEXT,
+    relapse INTEGER,
+    relapse_date TEXT,
+    relapse_site TEXT,
+    os_months_optional REAL,
+    dfs_months_optional REAL,
+    notes_fu TEXT,
+    FOREIGN KEY (patient_id) REFERENCES Patient(patient_id) ON DELETE CASCADE
+);
+
+-- FollowUpEvent table (New event-driven system)
+CREATE TABLE IF NOT EXISTS FollowUpEvent (
+    event_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    patient_id INTEGER NOT NULL,
+    event_date TEXT NOT NULL,
+    event_type TEXT NOT NULL,
+    event_details TEXT,
+    event_code TEXT NOT NULL,
+    FOREIGN KEY (patient_id) REFERENCES Patient(patient_id) ON DELETE CASCADE
+);
+DROP INDEX IF EXISTS idx_followup_event_patient_id;
+CREATE INDEX IF NOT EXISTS idx_fue_patient_date ON FollowUpEvent(patient_id, event_date DESC, event_id DESC);
+CREATE INDEX IF NOT EXISTS idx_followup_event_date ON FollowUpEvent(event_date DESC);
+CREATE UNIQUE INDEX IF NOT EXISTS idx_followup_event_code ON FollowUpEvent(patient_id, event_code);
+
+-- Mapping tables for staging
+CREATE TABLE IF NOT EXISTS map_lung_v9 (
+    t TEXT,
+    n TEXT,
+    m TEXT,
+    stage TEXT
+);
+CREATE TABLE IF NOT EXISTS map_eso_v9_scc (
+    t TEXT,
+    n TEXT,
+    m TEXT,
+    grade TEXT,
+    location TEXT,
+    stage TEXT
+);
+CREATE TABLE IF NOT EXISTS map_eso_v9_ad (
+    t TEXT,
+    n TEXT,
+    m TEXT,
+    grade TEXT,
+    location TEXT,
+    stage TEXT
+);
+-- Staging lookups match on every column but stage; the indexes carry stage
+-- too, so a lookup is answered from the index alone
+CREATE INDEX IF NOT EXISTS idx_map_lung ON map_lung_v9(t, n, m, stage);
+CREATE INDEX IF NOT EXISTS idx_map_eso_scc ON map_eso_v9_scc(t, n, m, grade, location, stage);
+CREATE INDEX IF NOT EXISTS idx_map_eso_ad ON map_eso_v9_ad(t, n, m, grade, location, stage);
+"""
+
+
 class Database:
     """SQLite database wrapper for thoracic entry application."""
 
-    def __init__(self, db_path: Optional[Path] = None) -> None:
+    def __init__(self, db_path: Optional[Path] = None, autocommit: bool = True) -> None:
+        """Open (creating or migrating if needed) the database at ``db_path``.
+
+        With ``autocommit`` (the default) every DAO write commits on its own,
+        as it always has.  Pass ``autocommit=False`` to leave committing to
+        the caller, or group writes with :meth:`transaction`.
+        """
         self.db_path = db_path or DEFAULT_DB_PATH
-        self.conn = sqlite3.connect(self.db_path)
+        self.autocommit = autocommit
+        self._in_transaction_block = False
+        # Idle read-only connections handed out by acquire_ro()
+        self._ro_pool: "queue.SimpleQueue[sqlite3.Connection]" = queue.SimpleQueue()
+        # Projection queries built by export_table, keyed by (table, exclude)
+        self._export_sql_cache: Dict[Tuple[str, frozenset], str] = {}
+        # A larger statement cache lets the memoised INSERT/UPDATE strings
+        # below reuse their prepared statements.
+        self.conn = sqlite3.connect(self.db_path, cached_statements=256)
         # Enable foreign key constraints
         self.conn.execute("PRAGMA foreign_keys = ON;")
+        self.conn.execute("PRAGMA journal_mode = WAL;")
+        self.conn.execute("PRAGMA synchronous = NORMAL;")
+        self.conn.execute("PRAGMA temp_store = MEMORY;")
+        self.conn.execute("PRAGMA cache_size = -65536;")  # 64 MB
+        self.conn.execute("PRAGMA mmap_size = 268435456;")  # 256 MB
         self.conn.row_factory = sqlite3.Row
-        self._create_schema()
-
-    def _create_schema(self) -> None:
-        """Create tables and indexes if they do not already exist."""
-        cur = self.conn.cursor()
-
-        # Patient table
-        cur.execute(
-            """
-            CREATE TABLE IF NOT EXISTS Patient (
-                patient_id INTEGER PRIMARY KEY AUTOINCREMENT,
-                hospital_id TEXT UNIQUE,
-                cancer_type TEXT,
-                sex TEXT,
-                birth_ym4 TEXT,
-                pack_years REAL,
-                multi_primary INTEGER,
-                lung_t TEXT,
-                lung_n TEXT,
-                lung_m TEXT,
-                eso_t TEXT,
-                eso_n TEXT,
-                eso_m TEXT,
-                eso_histology TEXT,
-                eso_grade TEXT,
-                eso_location TEXT,
-                eso_from_incisors_cm REAL,
-                diabetes_history INTEGER DEFAULT 0,
-                family_history INTEGER DEFAULT 0,
-                nac_chemo INTEGER,
-                nac_chemo_cycles INTEGER,
-                nac_immuno INTEGER,
-                nac_immuno_cycles INTEGER,
-                nac_targeted INTEGER,
-                nac_targeted_cycles INTEGER,
-                -- 新增: 新辅助放疗勾选
-                nac_radiation INTEGER,
-                -- 新增: 新辅助抗血管治疗 (v2.13)
-                nac_antiangio INTEGER,
-                nac_antiangio_cycles INTEGER,
-                -- 新增: 新辅助治疗日期 (yymmdd格式)
-                nac_date TEXT,
-                adj_chemo INTEGER,
-                adj_chemo_cycles INTEGER,
-                adj_immuno INTEGER,
-                adj_immuno_cycles INTEGER,
-                adj_targeted INTEGER,
-                adj_targeted_cycles INTEGER,
-                -- 新增: 辅助放疗勾选
-                adj_radiation INTEGER,
-                -- 新增: 辅助抗血管治疗 (v2.13)
-                adj_antiangio INTEGER,
-                adj_antiangio_cycles INTEGER,
-                -- 新增: 辅助治疗日期 (yymmdd格式)
-                adj_date TEXT,
-                notes_patient TEXT
-            );
-            """
-        )
-        # Index for cancer_type
-        cur.execute(
-            "CREATE INDEX IF NOT EXISTS idx_patient_cancer_type ON Patient(cancer_type);"
-        )
-
-        # Surgery table
-        cur.execute(
-            """
-            CREATE TABLE IF NOT EXISTS Surgery (
-                surgery_id INTEGER PRIMARY KEY AUTOINCREMENT,
-                patient_id INTEGER,
-                cancer_type TEXT,
-                surgery_date6 TEXT,
-                indication TEXT,
-                planned INTEGER DEFAULT 1,
-                completed INTEGER DEFAULT 1,
-                start_hhmm INTEGER,
-                end_hhmm INTEGER,
-                duration_min INTEGER,
-                ln_dissection INTEGER DEFAULT 1,
-                r0 INTEGER DEFAULT 1,
-                -- Lung specific
-                approach TEXT,
-                scope_lung TEXT,
-                lobe TEXT,
-                left_side INTEGER DEFAULT 0,
-                right_side INTEGER DEFAULT 0,
-                bilateral INTEGER,
-                lesion_count INTEGER,
-                main_lesion_size_cm REAL,
-                -- Esophageal specific
-                esophagus_site TEXT,
-                notes_surgery TEXT,
-                FOREIGN KEY (patient_id) REFERENCES Patient(patient_id) ON DELETE CASCADE
-            );
-            """
-        )
-        # Index on patient_id for faster lookups
-        cur.execute(
-            "CREATE INDEX IF NOT EXISTS idx_surgery_patient_id ON Surgery(patient_id);"
-        )
-
-        # Pathology table
-        cur.execute(
-            """
-            CREATE TABLE IF NOT EXISTS Pathology (
-                path_id INTEGER PRIMARY KEY AUTOINCREMENT,
-                patient_id INTEGER,
-                specimen_type TEXT,
-                histology TEXT,
-                differentiation TEXT,
-                pt TEXT,
-                pn TEXT,
-                pm TEXT,
-                p_stage TEXT,
-                lvi INTEGER,
-                pni INTEGER,
-                pleural_invasion INTEGER,
-                airway_spread INTEGER,
-                pathology_no TEXT,
-                -- 新增: 病理报告日期 (yymmdd格式)
-                pathology_date TEXT,
-                ln_total INTEGER,
-                ln_positive INTEGER,
-                trg INTEGER,
-                report_date TEXT,
-                notes_path TEXT,
-                -- 新增: 肺腺癌主要亚型
-                aden_subtype TEXT,
-                FOREIGN KEY (patient_id) REFERENCES Patient(patient_id) ON DELETE CASCADE
-            );
-            """
-        )
-        cur.execute(
-            "CREATE INDEX IF NOT EXISTS idx_path_patient_id ON Pathology(patient_id);"
-        )
-
-        # Molecular table
-        cur.execute(
-            """
-            CREATE TABLE IF NOT EXISTS Molecular (
-                mol_id INTEGER PRIMARY KEY AUTOINCREMENT,
-                patient_id INTEGER,
-                platform TEXT,
-                vendor_lab TEXT,
-                gene TEXT,
-                variant TEXT,
-                pdl1_percent REAL,
-                tmb_msi TEXT,
-                test_date TEXT,
-                genes_tested TEXT,
-                result_summary TEXT,
-                ctc_count INTEGER,
-                methylation_result TEXT,
-                notes_mol TEXT,
-                FOREIGN KEY (patient_id) REFERENCES Patient(patient_id) ON DELETE CASCADE
-            );
-            """
-        )
-        cur.execute(
-            "CREATE INDEX IF NOT EXISTS idx_mol_patient_id ON Molecular(patient_id);"
-        )
-
-        # FollowUp table (Legacy - kept for migration compatibility)
-        cur.execute(
-            """
-            CREATE TABLE IF NOT EXISTS FollowUp (
-                patient_id INTEGER PRIMARY KEY,
-                last_visit_date TEXT,
-                status TEXT,
-                death_date TEXT,
-                relapse INTEGER,
-                relapse_date TEXT,
-                relapse_site TEXT,
-                os_months_optional REAL,
-                dfs_months_optional REAL,
-                notes_fu TEXT,
-                FOREIGN KEY (patient_id) REFERENCES Patient(patient_id) ON DELETE CASCADE
-            );
-            """
-        )
-
-        # FollowUpEvent table (New event-driven system)
-        cur.execute(
-            """
-            CREATE TABLE IF NOT EXISTS FollowUpEvent (
-                event_id INTEGER PRIMARY KEY AUTOINCREMENT,
-                patient_id INTEGER NOT NULL,
-                event_date TEXT NOT NULL,
-                event_type TEXT NOT NULL,
-                event_details TEXT,
-                event_code TEXT NOT NULL,
-                FOREIGN KEY (patient_id) REFERENCES Patient(patient_id) ON DELETE CASCADE
-            );
-            """
-        )
-        cur.execute(
-            "CREATE INDEX IF NOT EXISTS idx_followup_event_patient_id ON FollowUpEvent(patient_id);"
-        )
-        cur.execute(
-            "CREATE INDEX IF NOT EXISTS idx_followup_event_date ON FollowUpEvent(event_date DESC);"
-        )
-        cur.execute(
-            "CREATE UNIQUE INDEX IF NOT EXISTS idx_followup_event_code ON FollowUpEvent(patient_id, event_code);"
-        )
-
-        # Mapping tables for staging
-        cur.execute(
-            """
-            CREATE TABLE IF NOT EXISTS map_lung_v9 (
-                t TEXT,
-                n TEXT,
-                m TEXT,
-                stage TEXT
-            );
-            """
-        )
-        cur.execute(
-            """
-            CREATE TABLE IF NOT EXISTS map_eso_v9_scc (
-                t TEXT,
-                n TEXT,
-                m TEXT,
-                grade TEXT,
-                location TEXT,
-                stage TEXT
-            );
-            """
-        )
-        cur.execute(
-            """
-            CREATE TABLE IF NOT EXISTS map_eso_v9_ad (
-                t TEXT,
-                n TEXT,
-                m TEXT,
-                grade TEXT,
-                location TEXT,
-                stage TEXT
-            );
-            """
-        )
-
-        self.conn.commit()
+        # A database already stamped with the current schema version has
+        # every table and index; skip re-issuing DDL.  Otherwise migrate on
+        # this same connection rather than opening the file a second time.
+        # migrate_database brings existing tables up to date, then applies
+        # _SCHEMA_SQL and stamps the version in the same transaction, so a
+        # failure part-way leaves the file to be migrated again next time.
+        if self.conn.execute("PRAGMA user_version").fetchone()[0] < SCHEMA_VERSION:
+            migrate_database(self.conn, _SCHEMA_SQL)
 
     def close(self) -> None:
         self.conn.close()
+        while True:
+            try:
+                self._ro_pool.get_nowait().close()
+            except queue.Empty:
+                break
+
+    # ------------------ Read-only connection pool ------------------
+    def _open_ro(self) -> sqlite3.Connection:
+        """Open a read-only connection that may be handed between threads."""
+        return open_ro_connection(self.db_path)
+
+    @contextmanager
+    def acquire_ro(self):
+        """Borrow a pooled read-only connection for use in a worker thread.
+
+        Usage::
+
+            with db.acquire_ro() as conn:
+                rows = conn.execute("SELECT ...").fetchall()
+
+        Connections are opened on demand and returned to the pool afterwards,
+        so parallel exports reuse them instead of reconnecting per query.
+        In WAL mode these readers run concurrently with each other and with
+        the main connection.  Only one thread may use a borrowed connection
+        at a time.
+        """
+        try:
+            conn = self._ro_pool.get_nowait()
+        except queue.Empty:
+            conn = self._open_ro()
+        try:
+            yield conn
+        finally:
+            self._ro_pool.put(conn)
+
+    def checkpoint(self) -> None:
+        """Copy all committed WAL content back into the main database file."""
+        self.conn.execute("PRAGMA wal_checkpoint(TRUNCATE);")
 
     # ------------------ Patient operations ------------------
     def insert_patient(self, data: Dict[str, Any], commit: bool = True) -> int:
@@ -319,30 +427,28 @@ class Database:
         Returns:
             The newly assigned patient_id.
         """
-        columns = ",".join(data.keys())
-        placeholders = ":" + ",:".join(data.keys())
-        sql = f"INSERT INTO Patient ({columns}) VALUES ({placeholders})"
-        cur = self.conn.cursor()
-        cur.execute(sql, data)
-        if commit:
-            self.conn.commit()
-        return cur.lastrowid
+        return self._insert_row("Patient", data, commit)
 
     def update_patient(self, patient_id: int, data: Dict[str, Any], commit: bool = True) -> None:
         """Update patient record with given fields."""
-        set_clause = ",".join([f"{k} = :{k}" for k in data.keys()])
-        sql = f"UPDATE Patient SET {set_clause} WHERE patient_id = :patient_id"
-        params = {**data, "patient_id": patient_id}
-        self.conn.execute(sql, params)
-        if commit:
-            self.conn.commit()
+        self._update_row("Patient", "patient_id", patient_id, data, commit)
 
-    def get_patient_by_id(self, patient_id: int) -> Optional[sqlite3.Row]:
-        cur = self.conn.execute("SELECT * FROM Patient WHERE patient_id=?", (patient_id,))
+    def get_patient_by_id(
+        self, patient_id: int, columns: Optional[Tuple[str, ...]] = None
+    ) -> Optional[sqlite3.Row]:
+        """Fetch one patient; pass ``columns`` to read only those fields."""
+        cur = self.conn.execute(
+            f"SELECT {_select_list(columns)} FROM Patient WHERE patient_id=?", (patient_id,)
+        )
         return cur.fetchone()
 
-    def get_patient_by_hospital_id(self, hospital_id: str) -> Optional[sqlite3.Row]:
-        cur = self.conn.execute("SELECT * FROM Patient WHERE hospital_id=?", (hospital_id,))
+    def get_patient_by_hospital_id(
+        self, hospital_id: str, columns: Optional[Tuple[str, ...]] = None
+    ) -> Optional[sqlite3.Row]:
+        """Fetch one patient by hospital_id; pass ``columns`` to read only those fields."""
+        cur = self.conn.execute(
+            f"SELECT {_select_list(columns)} FROM Patient WHERE hospital_id=?", (hospital_id,)
+        )
         return cur.fetchone()
 
     def delete_patient(self, patient_id: int) -> None:
@@ -357,134 +463,99 @@ class Database:
             follow‑up records.
         """
         self.conn.execute("DELETE FROM Patient WHERE patient_id=?", (patient_id,))
-        self.conn.commit()
+        self._autocommit()
 
     def search_patients(self, query: str) -> List[sqlite3.Row]:
-        """Search patients by partial hospital_id or patient_id (string)."""
-        q = f"%{query}%"
-        cur = self.conn.execute(
-            "SELECT * FROM Patient WHERE hospital_id LIKE ? OR CAST(patient_id AS TEXT) LIKE ? ORDER BY patient_id", (q, q)
-        )
-        return cur.fetchall()
+        """Search patients by hospital_id prefix or, for numeric input, exact patient_id.
+
+        The prefix match is written as a range on hospital_id so it can use
+        the column's UNIQUE index; a leading-wildcard LIKE (and a CAST on
+        patient_id) forced a full table scan on every search.
+        """
+        query = query.strip()
+        if not query:
+            return self.conn.execute("SELECT * FROM Patient ORDER BY patient_id").fetchall()
+        sql = "SELECT * FROM Patient WHERE (hospital_id >= ? AND hospital_id < ?)"
+        params: List[Any] = [query, query + "\U0010ffff"]
+        if query.isascii() and query.isdigit():
+            sql += " OR patient_id = ?"
+            params.append(int(query))
+        return self.conn.execute(sql + " ORDER BY patient_id", params).fetchall()
 
     # ------------------ Surgery operations ------------------
     def insert_surgery(self, patient_id: int, data: Dict[str, Any], commit: bool = True) -> int:
-        data = {**data, "patient_id": patient_id}
-        columns = ",".join(data.keys())
-        placeholders = ":" + ",:".join(data.keys())
-        sql = f"INSERT INTO Surgery ({columns}) VALUES ({placeholders})"
-        cur = self.conn.cursor()
-        cur.execute(sql, data)
-        if commit:
-            self.conn.commit()
-        return cur.lastrowid
+        return self._insert_row("Surgery", {**data, "patient_id": patient_id}, commit)
 
     def update_surgery(self, surgery_id: int, data: Dict[str, Any], commit: bool = True) -> None:
-        set_clause = ",".join([f"{k} = :{k}" for k in data.keys()])
-        params = {**data, "surgery_id": surgery_id}
-        sql = f"UPDATE Surgery SET {set_clause} WHERE surgery_id = :surgery_id"
-        self.conn.execute(sql, params)
-        if commit:
-            self.conn.commit()
+        self._update_row("Surgery", "surgery_id", surgery_id, data, commit)
 
-    def get_surgeries_by_patient(self, patient_id: int) -> List[sqlite3.Row]:
+    def get_surgeries_by_patient(
+        self, patient_id: int, columns: Optional[Tuple[str, ...]] = None
+    ) -> List[sqlite3.Row]:
         cur = self.conn.execute(
-            "SELECT * FROM Surgery WHERE patient_id=? ORDER BY surgery_date6 DESC", (patient_id,)
+            f"SELECT {_select_list(columns)} FROM Surgery WHERE patient_id=? ORDER BY surgery_date6 DESC",
+            (patient_id,),
         )
         return cur.fetchall()
 
     def delete_surgery(self, surgery_id: int) -> None:
         self.conn.execute("DELETE FROM Surgery WHERE surgery_id=?", (surgery_id,))
-        self.conn.commit()
+        self._autocommit()
 
     # ------------------ Pathology operations ------------------
     def insert_pathology(self, patient_id: int, data: Dict[str, Any], commit: bool = True) -> int:
-        data = {**data, "patient_id": patient_id}
-        columns = ",".join(data.keys())
-        placeholders = ":" + ",:".join(data.keys())
-        cur = self.conn.cursor()
-        cur.execute(f"INSERT INTO Pathology ({columns}) VALUES ({placeholders})", data)
-        if commit:
-            self.conn.commit()
-        return cur.lastrowid
+        return self._insert_row("Pathology", {**data, "patient_id": patient_id}, commit)
 
     def update_pathology(self, path_id: int, data: Dict[str, Any], commit: bool = True) -> None:
-        set_clause = ",".join([f"{k} = :{k}" for k in data.keys()])
-        params = {**data, "path_id": path_id}
-        sql = f"UPDATE Pathology SET {set_clause} WHERE path_id = :path_id"
-        self.conn.execute(sql, params)
-        if commit:
-            self.conn.commit()
+        self._update_row("Pathology", "path_id", path_id, data, commit)
 
-    def get_pathologies_by_patient(self, patient_id: int) -> List[sqlite3.Row]:
+    def get_pathologies_by_patient(
+        self, patient_id: int, columns: Optional[Tuple[str, ...]] = None
+    ) -> List[sqlite3.Row]:
         """
         Return all pathology records for a patient ordered by path_id descending.  Previously
         this ordered by report_date, but pathology_no replaces report_date so ordering by
         autoincrementing ID makes more sense.
         """
         cur = self.conn.execute(
-            "SELECT * FROM Pathology WHERE patient_id=? ORDER BY path_id DESC", (patient_id,)
+            f"SELECT {_select_list(columns)} FROM Pathology WHERE patient_id=? ORDER BY path_id DESC",
+            (patient_id,),
         )
         return cur.fetchall()
 
     def delete_pathology(self, path_id: int) -> None:
         self.conn.execute("DELETE FROM Pathology WHERE path_id=?", (path_id,))
-        self.conn.commit()
+        self._autocommit()
 
     # ------------------ Molecular operations ------------------
     def insert_molecular(self, patient_id: int, data: Dict[str, Any], commit: bool = True) -> int:
-        data = {**data, "patient_id": patient_id}
-        columns = ",".join(data.keys())
-        placeholders = ":" + ",:".join(data.keys())
-        cur = self.conn.cursor()
-        cur.execute(f"INSERT INTO Molecular ({columns}) VALUES ({placeholders})", data)
-        if commit:
-            self.conn.commit()
-        return cur.lastrowid
+        return self._insert_row("Molecular", {**data, "patient_id": patient_id}, commit)
 
     def update_molecular(self, mol_id: int, data: Dict[str, Any], commit: bool = True) -> None:
-        set_clause = ",".join([f"{k} = :{k}" for k in data.keys()])
-        params = {**data, "mol_id": mol_id}
-        sql = f"UPDATE Molecular SET {set_clause} WHERE mol_id = :mol_id"
-        self.conn.execute(sql, params)
-        if commit:
-            self.conn.commit()
+        self._update_row("Molecular", "mol_id", mol_id, data, commit)
 
-    def get_molecular_by_patient(self, patient_id: int) -> List[sqlite3.Row]:
+    def get_molecular_by_patient(
+        self, patient_id: int, columns: Optional[Tuple[str, ...]] = None
+    ) -> List[sqlite3.Row]:
         cur = self.conn.execute(
-            "SELECT * FROM Molecular WHERE patient_id=? ORDER BY test_date DESC", (patient_id,)
+            f"SELECT {_select_list(columns)} FROM Molecular WHERE patient_id=? ORDER BY test_date DESC",
+            (patient_id,),
         )
         return cur.fetchall()
 
     def delete_molecular(self, mol_id: int) -> None:
         self.conn.execute("DELETE FROM Molecular WHERE mol_id=?", (mol_id,))
-        self.conn.commit()
+        self._autocommit()
 
     # ------------------ Follow-up operations ------------------
     def insert_or_update_followup(self, patient_id: int, data: Dict[str, Any]) -> None:
         """Insert a followup if not exists, otherwise update existing record."""
-        cur = self.conn.execute(
-            "SELECT patient_id FROM FollowUp WHERE patient_id=?", (patient_id,)
-        )
-        exists = cur.fetchone() is not None
-        if exists:
-            self.update_followup(patient_id, data)
-        else:
-            data_with_id = {**data, "patient_id": patient_id}
-            columns = ",".join(data_with_id.keys())
-            placeholders = ":" + ",:".join(data_with_id.keys())
-            self.conn.execute(
-                f"INSERT INTO FollowUp ({columns}) VALUES ({placeholders})", data_with_id
-            )
-            self.conn.commit()
+        data_with_id = {**data, "patient_id": patient_id}
+        self.conn.execute(_upsert_sql("FollowUp", _column_key(data_with_id), "patient_id"), data_with_id)
+        self._autocommit()
 
     def update_followup(self, patient_id: int, data: Dict[str, Any]) -> None:
-        set_clause = ",".join([f"{k} = :{k}" for k in data.keys()])
-        params = {**data, "patient_id": patient_id}
-        self.conn.execute(
-            f"UPDATE FollowUp SET {set_clause} WHERE patient_id = :patient_id", params
-        )
-        self.conn.commit()
+        self._update_row("FollowUp", "patient_id", patient_id, data)
 
     def get_followup(self, patient_id: int) -> Optional[sqlite3.Row]:
         cur = self.conn.execute(
@@ -494,12 +565,20 @@ class Database:
 
     # ------------------ FollowUpEvent operations (New event-driven system) ------------------
     def generate_unique_event_code(self, patient_id: int, length: int = 6) -> str:
-        """Generate a random numeric event code unique within a patient."""
-        alphabet = string.digits
-        while True:
-            candidate = "".join(random.choices(alphabet, k=length))
-            if not self.is_event_code_taken(patient_id, candidate):
-                return candidate
+        """Generate a random numeric event code unique within a patient.
+
+        The patient's existing codes are fetched with one query and the
+        candidate is checked in memory, instead of one query per attempt.
+        """
+        return _pick_event_code(self.get_event_codes(patient_id), length)
+
+    def get_event_codes(self, patient_id: int) -> set:
+        """Return the set of event codes already used by a patient."""
+        return {
+            row[0] for row in self.conn.execute(
+                "SELECT event_code FROM FollowUpEvent WHERE patient_id=?", (patient_id,)
+            )
+        }
 
     def is_event_code_taken(
         self,
@@ -534,8 +613,7 @@ class Database:
             "INSERT INTO FollowUpEvent (patient_id, event_date, event_type, event_details, event_code) VALUES (?, ?, ?, ?, ?)",
             (patient_id, event_date, event_type, event_details, code),
         )
-        if commit:
-            self.conn.commit()
+        self._autocommit(commit)
         return cur.lastrowid
 
     def update_followup_event(
@@ -563,8 +641,7 @@ class Database:
             """,
             (event_date, event_type, event_details, code, event_id, patient_id),
         )
-        if commit:
-            self.conn.commit()
+        self._autocommit(commit)
 
     def get_followup_event_by_id(self, event_id: int) -> Optional[sqlite3.Row]:
         """Retrieve a single follow-up event by its primary key."""
@@ -572,10 +649,13 @@ class Database:
             "SELECT * FROM FollowUpEvent WHERE event_id=?", (event_id,)
         ).fetchone()
 
-    def get_followup_events(self, patient_id: int) -> List[sqlite3.Row]:
+    def get_followup_events(
+        self, patient_id: int, columns: Optional[Tuple[str, ...]] = None
+    ) -> List[sqlite3.Row]:
         """Get all follow-up events for a patient, ordered by date descending (newest first)."""
         cur = self.conn.execute(
-            "SELECT * FROM FollowUpEvent WHERE patient_id=? ORDER BY event_date DESC, event_id DESC",
+            f"SELECT {_select_list(columns)} FROM FollowUpEvent WHERE patient_id=? "
+            "ORDER BY event_date DESC, event_id DESC",
             (patient_id,)
         )
         return cur.fetchall()
@@ -583,21 +663,186 @@ class Database:
     def delete_followup_event(self, event_id: int) -> None:
         """Delete a specific follow-up event."""
         self.conn.execute("DELETE FROM FollowUpEvent WHERE event_id=?", (event_id,))
-        self.conn.commit()
+        self._autocommit()
+
+    # ------------------ Single-row helpers ------------------
+    def _insert_row(self, table: str, data: Dict[str, Any], commit: bool = True) -> int:
+        """Insert one row through the memoised INSERT for its columns; return its rowid."""
+        cur = self.conn.cursor()
+        cur.execute(_insert_sql(table, _column_key(data)), data)
+        self._autocommit(commit)
+        return cur.lastrowid
+
+    def _update_row(
+        self, table: str, key: str, key_value: Any, data: Dict[str, Any], commit: bool = True
+    ) -> None:
+        """Update the row whose ``key`` equals ``key_value`` with the fields in ``data``."""
+        self.conn.execute(_update_sql(table, _column_key(data), key), {**data, key: key_value})
+        self._autocommit(commit)
+
+    # ------------------ Bulk insert operations ------------------
+    def _insert_many(self, table: str, rows: List[Dict[str, Any]], commit: bool) -> int:
+        """Insert rows with one ``executemany`` per distinct set of keys.
+
+        Rows are grouped by column signature so each group binds against a
+        single prepared statement; everything commits once at the end.
+        """
+        if not rows:
+            return 0
+        groups: Dict[Tuple[str, ...], List[Dict[str, Any]]] = {}
+        for row in rows:
+            groups.setdefault(_column_key(row), []).append(row)
+        for columns, group in groups.items():
+            self.conn.executemany(_insert_sql(table, columns), group)
+        self._autocommit(commit)
+        return len(rows)
+
+    def insert_many_patients(self, rows: List[Dict[str, Any]], commit: bool = True) -> int:
+        """Insert several patient rows at once.
+
+        Generated patient_ids are not returned; look them up by hospital_id
+        if they are needed.  Returns the number of rows inserted.
+        """
+        return self._insert_many("Patient", rows, commit)
+
+    def insert_many_surgery(self, rows: List[Dict[str, Any]], commit: bool = True) -> int:
+        """Insert several surgery rows (each including ``patient_id``) at once.
+
+        Rows may have differing keys.  Returns the number of rows inserted.
+        """
+        return self._insert_many("Surgery", rows, commit)
+
+    def insert_many_pathology(self, rows: List[Dict[str, Any]], commit: bool = True) -> int:
+        """Insert several pathology rows (each including ``patient_id``) at once."""
+        return self._insert_many("Pathology", rows, commit)
+
+    def insert_many_molecular(self, rows: List[Dict[str, Any]], commit: bool = True) -> int:
+        """Insert several molecular rows (each including ``patient_id``) at once."""
+        return self._insert_many("Molecular", rows, commit)
+
+    def insert_many_followup_events(self, rows: List[Dict[str, Any]], commit: bool = True) -> int:
+        """Insert several follow-up events at once.
+
+        Each row needs ``patient_id``, ``event_date``, ``event_type``,
+        ``event_details`` and ``event_code``; a missing code is generated.
+        """
+        used: Dict[int, set] = {}
+
+        def codes_for(patient_id: int) -> set:
+            if patient_id not in used:
+                used[patient_id] = self.get_event_codes(patient_id)
+            return used[patient_id]
+
+        rows = [
+            row if row.get("event_code")
+            else {**row, "event_code": _pick_event_code(codes_for(row["patient_id"]))}
+            for row in rows
+        ]
+        return self._insert_many("FollowUpEvent", rows, commit)
+
+    def bulk_insert_followup_events(
+        self,
+        patient_id: int,
+        events: Iterable[Tuple[str, str, str]],
+        commit: bool = True,
+    ) -> int:
+        """Insert several ``(event_date, event_type, event_details)`` events for one patient.
+
+        The patient's existing codes are read once and new codes are drawn
+        against that set, so no per-event lookups are needed.  Returns the
+        number of events inserted.
+        """
+        used = self.get_event_codes(patient_id)
+        rows = [
+            (patient_id, event_date, event_type, event_details or "", _pick_event_code(used))
+            for event_date, event_type, event_details in events
+        ]
+        self.conn.executemany(
+            "INSERT INTO FollowUpEvent (patient_id, event_date, event_type, event_details, event_code) VALUES (?, ?, ?, ?, ?)",
+            rows,
+        )
+        self._autocommit(commit)
+        return len(rows)
 
     def commit(self) -> None:
         """Manual commit wrapper."""
         self.conn.commit()
 
+    def _autocommit(self, commit: bool = True) -> None:
+        """Commit after a DAO write unless the caller manages the transaction."""
+        if commit and self.autocommit:
+            self.conn.commit()
+
+    @contextmanager
+    def transaction(self):
+        """Run several DAO writes as one transaction with a single commit.
+
+        Usage::
+
+            with db.transaction():
+                db.insert_surgery(pid, data)
+                db.insert_pathology(pid, other)
+
+        Commits when the block succeeds and rolls back if it raises.
+        Per-method commits are suppressed inside the block; nested blocks
+        join the outermost one.  The block starts with BEGIN IMMEDIATE, so
+        the write lock is taken up front and reads made inside the block
+        cannot go stale before its writes land.
+        """
+        if self._in_transaction_block:
+            yield self.conn
+            return
+        saved_autocommit = self.autocommit
+        self._in_transaction_block = True
+        self.autocommit = False
+        try:
+            with self.conn:
+                if not self.conn.in_transaction:
+                    self.conn.execute("BEGIN IMMEDIATE")
+                yield self.conn
+        finally:
+            self.autocommit = saved_autocommit
+            self._in_transaction_block = False
+
     # ------------------ General operations ------------------
-    def export_table(self, table_name: str) -> List[sqlite3.Row]:
-        """Return all rows for the given table for export purposes."""
-        # 白名单验证表名，防止SQL注入
-        allowed_tables = ['Patient', 'Surgery', 'Pathology', 'Molecular', 'FollowUp', 'FollowUpEvent']
-        if table_name not in allowed_tables:
+    def export_table(
+        self,
+        table_name: str,
+        columns: Optional[Tuple[str, ...]] = None,
+        exclude: Iterable[str] = (),
+    ) -> Iterator[sqlite3.Row]:
+        """Iterate over all rows of the given table for export purposes.
+
+        Rows are streamed from the cursor rather than collected into a list,
+        so memory stays flat however large the table is; wrap the result in
+        ``list()`` if random access is needed.  ``columns`` restricts the
+        export to those fields; each must exist in the table.  ``exclude``
+        instead names fields to leave out of the SELECT, so they are never
+        read at all.  The table and column names are validated immediately,
+        before any row is read.
+        """
+        # 白名单验证表名，防止SQL注入；白名单同时保存预先拼好的整表查询语句
+        sql = _EXPORT_SQL.get(table_name)
+        if sql is None:
             raise ValueError(f"Invalid table name: {table_name}")
-        cur = self.conn.execute(f"SELECT * FROM {table_name}")
-        return cur.fetchall()
+        if columns:
+            unknown = set(columns) - set(self.get_columns(table_name))
+            if unknown:
+                raise ValueError(f"Invalid column name(s) for {table_name}: {sorted(unknown)}")
+            sql = f"SELECT {_select_list(columns)} FROM {table_name}"
+        elif exclude:
+            key = (table_name, frozenset(exclude))
+            sql = self._export_sql_cache.get(key)
+            if sql is None:
+                kept = tuple(c for c in self.get_columns(table_name) if c not in key[1])
+                sql = f"SELECT {_select_list(kept)} FROM {table_name}"
+                self._export_sql_cache[key] = sql
+        return iter(self.conn.execute(sql))
+
+    def get_columns(self, table_name: str) -> List[str]:
+        """Return the column names of ``table_name`` in schema order."""
+        cur = self.conn.execute(f"PRAGMA table_info({table_name})")
+        return [row[1] for row in cur.fetchall()]
 
     def list_tables(self) -> List[str]:
         """Return list of table names in current database (excluding sqlite internal)."""
@@ -16,17 +16,24 @@ from __future__ import annotations
 
 import csv
 
+import functools
+
+import itertools
+
+import operator
+
+import sqlite3
+
 from pathlib import Path
 
-from typing import Iterable, List, Optional, Callable
+from typing import Dict, Iterable, List, Optional, Callable, Sequence, Tuple, Union
 
 from db.models import Database
 # 引入并行处理工具
-from export.parallel import parallel_fetch_tables, parallel_write_csv_files, ExportProgress
-
-# 引入日期格式化函数以统一导出中的日期格式
-
-from utils.validators import format_date6, format_birth_ym4, format_birth_ym6
+from export.parallel import (
+    parallel_fetch_tables, parallel_write_csv_files, parallel_export_tables, ExportProgress,
+    SEQUENCE_DATE_COLUMNS, PROCESS_WRITE_MIN_ROWS, estimate_table_rows,
+)
 
 # 引入分期查询函数用于导出时补充临床分期
 
@@ -45,6 +52,10 @@ from utils.validators import format_date6, format_birth_ym4, format_birth_ym6
 # 排除导出字段列表：新增 event_code 用于隐藏随访事件的内部编号
 EXCLUDE_FIELDS = {"vendor_lab", "ln_total", "ln_positive", "patient_id", "event_code"}
 
+# 写 CSV 文件时的缓冲区大小 (1 MB)，减少大文件导出时的写系统调用次数
+
+WRITE_BUFFER_SIZE = 1 << 20
+
 # 日期字段映射。需要统一导出格式的列名列表。
 
 # birth_ym4 将在格式化时保持为 yyyymm；其他列将格式化为 yyyymmdd。
@@ -83,248 +94,293 @@ DATE_LIKE_CYCLE_FIELDS = {
 
 }
 
-def _format_value(col: str, val: object) -> object:
+# 日期列的导出格式规则：导出查询直接在 SQLite 中完成日期转换，
 
-    """根据列名格式化日期字段。
+# 逐行写出时不再格式化。{col} 为列名占位符。
+_SQL_TEXT = "CAST({col} AS TEXT)"
 
-    对于 6 位的日期 (yymmdd) 使用 format_date6 转换为 yyyy-mm-dd 再去掉横杠。
+_SQL_CENTURY = f"CASE WHEN substr({_SQL_TEXT}, 1, 2) <= '30' THEN '20' ELSE '19' END"
 
-    对于 birth_ym4 兼容旧的 4 位格式以及新的 6 位格式，输出 yyyymm。
+def _sql_digits(length: int) -> str:
 
-    其他字段返回原值。
+    """值恰为 length 位（ASCII）数字的 SQL 条件。"""
 
-    """
+    return f"(length({_SQL_TEXT}) = {length} AND {_SQL_TEXT} NOT GLOB '*[^0-9]*')"
 
-    if val is None or val == "":
+# 6 位 yymmdd 且月/日通过与 validate_date6 相同的检查（2 月不区分闰年）
 
-        return val
+_SQL_VALID_DATE6 = (
 
-    # convert to string for processing
+    f"{_sql_digits(6)} AND substr({_SQL_TEXT}, 3, 2) BETWEEN '01' AND '12'"
 
-    s = str(val)
+    f" AND substr({_SQL_TEXT}, 5, 2) BETWEEN '01' AND '31'"
 
-    # birth year-month
+    f" AND NOT (substr({_SQL_TEXT}, 3, 2) IN ('04', '06', '09', '11') AND substr({_SQL_TEXT}, 5, 2) > '30')"
 
-    if col == "birth_ym4":
+    f" AND NOT (substr({_SQL_TEXT}, 3, 2) = '02' AND substr({_SQL_TEXT}, 5, 2) > '29')"
 
-        # 长度为 4 的旧格式 yymm
+)
 
-        if len(s) == 4 and s.isdigit():
+_SQL_DATE8 = (
 
-            formatted = format_birth_ym4(s)
+    f"CASE WHEN {_sql_digits(8)} THEN {_SQL_TEXT}"
 
-            return formatted.replace("-", "") if formatted else s
+    f" WHEN instr({_SQL_TEXT}, '-') > 0 THEN replace({_SQL_TEXT}, '-', '')"
 
-        # 长度为 6 的新格式 yyyymm
+    f" WHEN {_SQL_VALID_DATE6} THEN {_SQL_CENTURY} || {_SQL_TEXT}"
 
-        if len(s) == 6 and s.isdigit():
+    f" ELSE {_SQL_TEXT} END"
 
-            formatted = format_birth_ym6(s)
+)
 
-            return formatted.replace("-", "") if formatted else s
+_SQL_CYCLE_DATE = (
 
-        # 其它情况不处理
+    f"CASE WHEN {_SQL_VALID_DATE6} THEN {_SQL_CENTURY} || substr({_SQL_TEXT}, 1, 2)"
 
-        return s
+    f" || '-' || substr({_SQL_TEXT}, 3, 2) || '-' || substr({_SQL_TEXT}, 5, 2)"
 
-    # 日期字段
+    f" ELSE {_SQL_TEXT} END"
 
-    if col in DATE_FIELDS_8:
+)
 
-        # 如果已经是 8 位数字，则直接返回
+# 4 位 yymm 补全世纪；6 位 yyyymm 无论是否有效都原样输出
 
-        if len(s) == 8 and s.isdigit():
+_SQL_BIRTH_YM = (
 
-            return s
+    f"CASE WHEN {_sql_digits(4)} AND substr({_SQL_TEXT}, 3, 2) BETWEEN '01' AND '12'"
 
-        # 如果包含横杠，则去除横杠
+    f" THEN {_SQL_CENTURY} || {_SQL_TEXT} ELSE {_SQL_TEXT} END"
 
-        if "-" in s:
+)
 
-            return s.replace("-", "")
+SQL_FORMATS = {
 
-        # 如果是 6 位数字 (yymmdd)，则转化为 yyyy-mm-dd 后再去除横杠
+    **{col: _SQL_DATE8 for col in DATE_FIELDS_8},
 
-        if len(s) == 6 and s.isdigit():
+    **{col: _SQL_CYCLE_DATE for col in DATE_LIKE_CYCLE_FIELDS},
 
-            formatted = format_date6(s)
+    "birth_ym4": _SQL_BIRTH_YM,
 
-            return formatted.replace("-", "") if formatted else s
+}
 
-        # 其它情况不处理
+# 移除 `_annotate_stage` 函数。临床分期映射功能已取消，不再补充分期字段。
 
-        return s
+def _reorder_pathology(row_dict: dict) -> dict:
 
-    if col in DATE_LIKE_CYCLE_FIELDS:
+    """Reorder pathology row so that airway_spread appears before pleural_invasion."""
 
-        if len(s) == 6 and s.isdigit():
+    if "airway_spread" in row_dict and "pleural_invasion" in row_dict:
 
-            formatted = format_date6(s)
+        airway_val = row_dict.pop("airway_spread")
 
-            return formatted or s
+        new_dict = {}
 
-        return s
+        for k, v in row_dict.items():
 
-    return val
+            if k == "pleural_invasion":
 
-def _format_row_dates(row_dict: dict) -> dict:
+                new_dict["airway_spread"] = airway_val
 
-    """Apply date formatting to all columns in a row."""
+            new_dict[k] = v
 
-    new_row = {}
+        return new_dict
 
-    for k, v in row_dict.items():
+    return row_dict
 
-        if k in EXCLUDE_FIELDS:
+def _csv_header(first_row: Union[dict, sqlite3.Row], table_name: str) -> List[str]:
 
-            continue
+    """Column order for a table's CSV: excluded fields dropped, Seq first."""
 
-        new_row[k] = _format_value(k, v)
+    header = [k for k in first_row.keys() if k not in EXCLUDE_FIELDS]
 
-    return new_row
+    if table_name == "Pathology":
 
-# 移除 `_annotate_stage` 函数。临床分期映射功能已取消，不再补充分期字段。
+        header = list(_reorder_pathology(dict.fromkeys(header)))
 
-def _clean_row(row_dict: dict) -> dict:
+    # Ensure 'Seq' is the first column if present
 
-    """Remove unwanted fields and format date values before export."""
+    if "Seq" in header:
 
-    formatted = _format_row_dates(row_dict)
+        header.remove("Seq")
 
-    return {k: v for k, v in formatted.items() if k not in EXCLUDE_FIELDS}
+        header = ["Seq"] + header
 
-def _reorder_pathology(row_dict: dict) -> dict:
+    return header
 
-    """Reorder pathology row so that airway_spread appears before pleural_invasion."""
+# (数据库路径, 表名) -> 导出表头，每张表只读取一次表结构
 
-    if "airway_spread" in row_dict and "pleural_invasion" in row_dict:
+_HEADERS: Dict[Tuple[str, str], List[str]] = {}
 
-        airway_val = row_dict.pop("airway_spread")
+def _table_header(db: Database, table_name: str) -> List[str]:
 
-        new_dict = {}
+    """Header of a table's CSV export, derived from its schema.
 
-        for k, v in row_dict.items():
+    Matches what :func:`_csv_header` gives for an exported row: Seq first
+    for numbered tables, hospital_id appended to child tables, excluded
+    fields dropped.  Memoised per database and table.
+    """
 
-            if k == "pleural_invasion":
+    key = (str(db.db_path), table_name)
 
-                new_dict["airway_spread"] = airway_val
+    header = _HEADERS.get(key)
 
-            new_dict[k] = v
+    if header is None:
 
-        return new_dict
+        with db.acquire_ro() as conn:
 
-    return row_dict
+            columns = [row[1] for row in conn.execute(f"PRAGMA table_info({table_name})")]
 
-def _annotate_sequence(rows: List[dict], table_name: str) -> List[dict]:
-    """Add a sequence number (1, 2, 3...) for each patient's records sorted by date.
-    
-    Applicable to Surgery, Pathology, Molecular, and FollowUpEvent tables.
+        row = dict.fromkeys(columns)
+
+        if table_name != "Patient":
+
+            row["hospital_id"] = None
+
+        if table_name in SEQUENCE_DATE_COLUMNS:
+
+            row["Seq"] = None
+
+        header = _csv_header(row, table_name)
+
+        _HEADERS[key] = header
+
+    return header
+
+def _make_row_transformer(
+
+    header: List[str],
+
+    row_keys: Optional[Sequence[str]] = None,
+
+) -> Optional[Callable[[Union[dict, sqlite3.Row]], Sequence]]:
+
+    """Compile a table's header into one function from row to output values.
+
+    The returned function only reads and orders the values of a row; date
+    columns were already formatted by the export query (see
+    :data:`SQL_FORMATS`).  Rows are dicts by default; pass ``row_keys`` (the
+    column names of a ``sqlite3.Row``) to read rows by position instead.
+    Returns ``None`` when positional rows already are the output record,
+    i.e. they hold exactly the header's columns in order.
     """
-    if table_name not in ["Surgery", "Pathology", "Molecular", "FollowUpEvent"]:
-        return rows
-    
-    # Sort all rows by date to ensure consistent numbering
-    date_field_map = {
-        "Surgery": "surgery_date6",
-        "Pathology": "pathology_date",
-        "Molecular": "test_date",
-        "FollowUpEvent": "event_date"
-    }
-    date_col = date_field_map.get(table_name)
-    if not date_col:
-        return rows
-
-    # Group rows by patient_id
-    grouped = {}
-    for row in rows:
-        pid = row.get("patient_id")
-        if pid not in grouped:
-            grouped[pid] = []
-        grouped[pid].append(row)
-    
-    annotated_rows = []
-    # For each patient, sort by date ascending and assign sequence
-    for pid in grouped:
-        patient_rows = grouped[pid]
-        # Sort by date ascending
-        patient_rows.sort(key=lambda x: str(x.get(date_col) or ""))
-        
-        for i, row in enumerate(patient_rows, 1):
-            # Create a new dict to avoid modifying original if shared
-            new_row = row.copy()
-            new_row["Seq"] = i
-            annotated_rows.append(new_row)
-            
-    return annotated_rows
 
+    if row_keys is not None:
 
-def _write_csv(path: Path, rows: Iterable[dict], table_name: str) -> None:
+        keys = list(row_keys)
 
-    """Write a list of dictionaries to a CSV file after cleaning and formatting."""
+        indexes = tuple(keys.index(k) for k in header)
 
-    try:
+        if indexes == tuple(range(len(keys))):
 
-        # Convert to list
-        rows_list_raw = [dict(row) if not isinstance(row, dict) else row for row in rows]
-        
-        # Add sequence numbers if applicable
-        if table_name in ["Surgery", "Pathology", "Molecular", "FollowUpEvent"]:
-            rows_list_raw = _annotate_sequence(rows_list_raw, table_name)
+            return None
+
+        if len(indexes) > 1:
+
+            return operator.itemgetter(*indexes)
+
+        def transform_row(row: sqlite3.Row) -> list:
+
+            return [row[i] for i in indexes]
+
+        return transform_row
 
-        # Clean and format
-        rows_list = []
+    def transform(row: dict) -> list:
 
-        for row in rows_list_raw:
+        get = row.get
 
-            try:
+        return [get(k) for k in header]
 
-                row_dict = dict(row)
+    return transform
 
-                cleaned = _clean_row(row_dict)
+def _csv_records(
 
-                if table_name == "Pathology":
+    rows: Iterable[Union[dict, sqlite3.Row]],
 
-                    cleaned = _reorder_pathology(cleaned)
+    transform: Callable[[Union[dict, sqlite3.Row]], Sequence],
 
-                rows_list.append(cleaned)
+    table_name: str,
 
-            except Exception as e:
+) -> Iterable[Sequence]:
 
-                print(f"Warning: Failed to process row in {table_name}: {e}")
+    """Yield each row as a record of formatted values in header order."""
 
-                continue
+    for row in rows:
+
+        try:
+
+            yield transform(row)
+
+        except Exception as e:
 
-        if not rows_list:
+            print(f"Warning: Failed to process row in {table_name}: {e}")
 
-            # Nothing to write
+def _write_csv(
 
-            path.parent.mkdir(parents=True, exist_ok=True)
+    path: Path,
 
-            with path.open("w", newline="", encoding="utf-8") as f:
+    rows: Iterable[Union[dict, sqlite3.Row, tuple]],
 
-                pass
+    table_name: str,
 
-            return
+    header: Optional[List[str]] = None,
+
+    row_keys: Optional[Sequence[str]] = None,
+
+) -> None:
+
+    """Write rows (dicts, ``sqlite3.Row`` or tuples) to a CSV file in header order.
+
+    ``header`` (see :func:`_table_header`) fixes the columns, so an export
+    with no rows still gets its header line; without it the header is
+    worked out from the first row and an empty export writes an empty file.
+    Each row is formatted straight into a list in header order and streamed
+    through ``csv.writer.writerows``; positional rows that already match
+    the header are handed to the writer as they are.  Plain tuples need
+    ``row_keys``, the column name of each position (``sqlite3.Row`` supplies
+    its own).  Sequence numbers (``Seq``) and formatted date columns (see
+    :data:`SQL_FORMATS`) are expected to come with the rows, as computed by
+    the export query.
+    """
+
+    try:
+
+        row_iter = iter(rows)
+
+        first_row = next(row_iter, None)
 
         # 确保目录存在
 
         path.parent.mkdir(parents=True, exist_ok=True)
 
-        with path.open("w", newline="", encoding="utf-8") as f:
-            
-            # Ensure 'Seq' is the first column if present
-            header = list(rows_list[0].keys())
-            if "Seq" in header:
-                header.remove("Seq")
-                header = ["Seq"] + header
+        with path.open("w", newline="", encoding="utf-8", buffering=WRITE_BUFFER_SIZE) as f:
+
+            if header is None:
+
+                if first_row is None:
 
-            writer = csv.DictWriter(f, fieldnames=header)
+                    # Nothing to write
 
-            writer.writeheader()
+                    return
 
-            for row in rows_list:
+                header = _csv_header(first_row if row_keys is None else dict.fromkeys(row_keys), table_name)
 
-                writer.writerow(row)
+            writer = csv.writer(f, quoting=csv.QUOTE_MINIMAL)
+
+            writer.writerow(header)
+
+            if first_row is None:
+
+                return
+
+            if row_keys is None and not isinstance(first_row, dict):
+
+                row_keys = first_row.keys()
+
+            transform = _make_row_transformer(header, row_keys)
+
+            records = itertools.chain((first_row,), row_iter)
+
+            writer.writerows(records if transform is None else _csv_records(records, transform, table_name))
 
     except PermissionError as e:
 
@@ -334,6 +390,29 @@ def _write_csv(path: Path, rows: Iterable[dict], table_name: str) -> None:
 
         raise Exception(f"导出CSV文件失败: {str(e)}") from e
 
+def _write_table_csv(
+
+    headers: Dict[str, List[str]],
+
+    path: Path,
+
+    rows: Iterable[Union[dict, tuple]],
+
+    table_name: str,
+
+    row_keys: Optional[Sequence[str]] = None,
+
+) -> None:
+
+    """Write ``table_name`` rows with its header from ``headers`` via :func:`_write_csv`.
+
+    Kept at module level so a ``functools.partial`` of it can be pickled.
+    The rows come from an export query run with ``column_sql=SQL_FORMATS``.
+    """
+
+    _write_csv(path, rows, table_name, headers[table_name], row_keys)
+
+
 def export_patient_to_csv(
     db: Database, 
     patient_id: int, 
@@ -376,29 +455,30 @@ def export_patient_to_csv(
         table_data = parallel_fetch_tables(
             db, tables, patient_id=patient_id,
             max_workers=min(4, len(tables)),
-            progress_tracker=fetch_progress
+            progress_tracker=fetch_progress,
+            exclude=EXCLUDE_FIELDS,
+            with_sequence=True,
+            with_hospital_id=True,
+            column_sql=SQL_FORMATS,
         )
         
-        # 获取患者的 hospital_id
+        # 获取患者的 hospital_id；各子表行的 hospital_id 已在查询时关联得到
         patient_rows = table_data.get("Patient", [])
         if not patient_rows:
             raise ValueError(f"Patient with ID {patient_id} not found")
         
         # 如果hospital_id为空，使用patient_id作为备用标识
-        hospital_id = patient_rows[0].get("hospital_id") or f"PID_{patient_id}"
+        if not patient_rows[0].get("hospital_id"):
+            fallback_id = f"PID_{patient_id}"
+            for table in tables:
+                if table != "Patient":
+                    for rdict in table_data.get(table, []):
+                        rdict["hospital_id"] = fallback_id
         
         # 准备写入任务
         file_tasks = []
         for table in tables:
-            if table == "Patient":
-                rows = patient_rows
-            else:
-                # Attach hospital_id to each row
-                rows = table_data.get(table, [])
-                if hospital_id is not None:
-                    for rdict in rows:
-                        rdict["hospital_id"] = hospital_id
-            
+            rows = table_data.get(table, [])
             file_path = dir_path / f"{prefix}_{table}.csv"
             file_tasks.append((file_path, rows, table))
         
@@ -410,8 +490,11 @@ def export_patient_to_csv(
                 progress_callback(55 + p * 0.45)
             write_progress.set_callback(write_progress_callback)
         
+        # 表头按表结构一次确定，没有数据的表也写出表头
+        headers = {table: _table_header(db, table) for table in tables}
+
         files = parallel_write_csv_files(
-            file_tasks, _write_csv,
+            file_tasks, functools.partial(_write_table_csv, headers),
             max_workers=min(4, len(file_tasks)),
             progress_tracker=write_progress
         )
@@ -448,53 +531,32 @@ def export_all_to_csv(
         if progress_callback:
             progress_callback(5)
         
-        # 使用多线程并行获取所有表的数据
-        fetch_progress = ExportProgress(len(tables))
-        if progress_callback:
-            def fetch_progress_callback(p):
-                # 数据获取阶段占 50% 进度
-                progress_callback(5 + p * 0.5)
-            fetch_progress.set_callback(fetch_progress_callback)
-        
-        table_data = parallel_fetch_tables(
-            db, tables, patient_id=None,
-            max_workers=min(4, len(tables)),
-            progress_tracker=fetch_progress
-        )
-        
-        # Precompute mapping from patient_id to hospital_id
-        patient_rows = table_data.get("Patient", [])
-        pat_map = {}
-        for rdict in patient_rows:
-            pat_map[rdict.get("patient_id")] = rdict.get("hospital_id")
-        
-        # 准备写入任务
-        file_tasks = []
-        for table in tables:
-            rows_dicts: List[dict] = table_data.get(table, [])
-            
-            # Attach hospital_id for non-Patient tables
-            if table != "Patient":
-                for rdict in rows_dicts:
-                    pid = rdict.get("patient_id")
-                    if pid in pat_map:
-                        rdict["hospital_id"] = pat_map[pid]
-            
-            file_path = dir_path / f"{table}.csv"
-            file_tasks.append((file_path, rows_dicts, table))
+        # 每张表在各自的工作者中边查询边写入，整表数据不驻留内存；
+        # 非 Patient 表的 hospital_id 在查询时关联得到
+        file_tasks = [(dir_path / f"{table}.csv", table) for table in tables]
         
-        # 使用多线程并行写入 CSV 文件
         write_progress = ExportProgress(len(file_tasks))
         if progress_callback:
             def write_progress_callback(p):
-                # 文件写入阶段占 45% 进度
-                progress_callback(55 + p * 0.45)
+                # 查询与写入同时进行，按已完成的文件数推进
+                progress_callback(5 + p * 0.95)
             write_progress.set_callback(write_progress_callback)
         
-        files = parallel_write_csv_files(
-            file_tasks, _write_csv,
+        # 表头按表结构一次确定，没有数据的表也写出表头
+        headers = {table: _table_header(db, table) for table in tables}
+
+        # 数据量大时在进程池中导出，写入函数须可被 pickle
+        use_processes = estimate_table_rows(db, tables) >= PROCESS_WRITE_MIN_ROWS
+
+        files = parallel_export_tables(
+            db, file_tasks, functools.partial(_write_table_csv, headers),
             max_workers=min(4, len(file_tasks)),
-            progress_tracker=write_progress
+            progress_tracker=write_progress,
+            use_processes=use_processes,
+            exclude=EXCLUDE_FIELDS,
+            with_sequence=True,
+            with_hospital_id=True,
+            column_sql=SQL_FORMATS,
         )
         
         if progress_callback:
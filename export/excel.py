@@ -11,8 +11,10 @@ Requires openpyxl; ensure it is installed prior to packaging.
 
 from __future__ import annotations
 
+import itertools
+from functools import lru_cache
 from pathlib import Path
-from typing import Dict, Iterable, List, Optional, Callable
+from typing import Dict, Iterable, List, Optional, Callable, Sequence, Union
 
 from openpyxl import Workbook
 
@@ -20,7 +22,7 @@ from db.models import Database
 # 引入日期格式化函数
 from utils.validators import format_date6, format_birth_ym4, format_birth_ym6
 # 引入并行处理工具
-from export.parallel import parallel_fetch_tables, ExportProgress
+from export.parallel import parallel_fetch_tables, stream_table_data, ExportProgress
 # 引入分期查询函数
 # 已删除临床分期映射功能，不再导入 staging.lookup 中的分期函数
 
@@ -30,6 +32,9 @@ from export.parallel import parallel_fetch_tables, ExportProgress
 # 排除导出字段列表：新增 event_code 用于隐藏随访事件的内部编号
 EXCLUDE_FIELDS = {"vendor_lab", "ln_total", "ln_positive", "patient_id", "event_code"}
 
+# 保存工作簿时文件对象的缓冲区大小
+WRITE_BUFFER_SIZE = 1 << 20
+
 # 与 CSV 导出一致的日期字段集合
 DATE_FIELDS_8 = {
     "surgery_date6",
@@ -49,46 +54,60 @@ DATE_LIKE_CYCLE_FIELDS = {
     "adj_chemo_cycles",
 }
 
-def _format_value(col: str, val: object) -> object:
-    """根据列名格式化日期字段。"""
+# 以下格式化函数只依赖传入的值，同一日期在各行中大量重复，
+# 按值（区分类型，230101 与 230101.0 输出不同）缓存结果，重复出现的值不再重新解析
+@lru_cache(maxsize=4096, typed=True)
+def _format_birth_ym(val: object) -> object:
+    """birth_ym4：4 位 yymm 或 6 位 yyyymm 输出为 yyyymm。"""
     if val is None or val == "":
         return val
     s = str(val)
-    if col == "birth_ym4":
-        if len(s) == 4 and s.isdigit():
-            formatted = format_birth_ym4(s)
-            return formatted.replace("-", "") if formatted else s
-        if len(s) == 6 and s.isdigit():
-            formatted = format_birth_ym6(s)
-            return formatted.replace("-", "") if formatted else s
-        return s
-    if col in DATE_LIKE_CYCLE_FIELDS:
-        if len(s) == 6 and s.isdigit():
-            formatted = format_date6(s)
-            return formatted or s
-        return s
-    if col in DATE_FIELDS_8:
-        if len(s) == 6 and s.isdigit():
-            formatted = format_date6(s)
-            return formatted.replace("-", "") if formatted else s
-        return s
-    return val
-
-def _format_row_dates(row_dict: dict) -> dict:
-    new_row = {}
-    for k, v in row_dict.items():
-        if k in EXCLUDE_FIELDS:
-            continue
-        new_row[k] = _format_value(k, v)
-    return new_row
+    if len(s) == 4 and s.isdigit():
+        formatted = format_birth_ym4(s)
+        return formatted.replace("-", "") if formatted else s
+    if len(s) == 6 and s.isdigit():
+        formatted = format_birth_ym6(s)
+        return formatted.replace("-", "") if formatted else s
+    return s
 
-# 移除 `_annotate_stage` 函数。临床分期映射功能已取消，不再补充分期字段。
+
+@lru_cache(maxsize=4096, typed=True)
+def _format_cycle_date(val: object) -> object:
+    """化疗周期列中误填的 6 位日期 (yymmdd) 转换为 yyyy-mm-dd。"""
+    if val is None or val == "":
+        return val
+    s = str(val)
+    if len(s) == 6 and s.isdigit():
+        return format_date6(s) or s
+    return s
+
+
+@lru_cache(maxsize=4096, typed=True)
+def _format_date8(val: object) -> object:
+    """6 位日期 (yymmdd) 转换为 yyyymmdd，其余原样输出。"""
+    if val is None or val == "":
+        return val
+    s = str(val)
+    if len(s) == 6 and s.isdigit():
+        formatted = format_date6(s)
+        return formatted.replace("-", "") if formatted else s
+    return s
+
+
+# 列名 -> 格式化函数；不在表中的列原样写出
+_FORMATTERS = {
+    **{col: _format_date8 for col in DATE_FIELDS_8},
+    **{col: _format_cycle_date for col in DATE_LIKE_CYCLE_FIELDS},
+    "birth_ym4": _format_birth_ym,
+}
 
 
-def _clean_row(row_dict: dict) -> dict:
-    """Remove unwanted fields and format date values before export."""
-    formatted = _format_row_dates(row_dict)
-    return {k: v for k, v in formatted.items() if k not in EXCLUDE_FIELDS}
+def _format_value(col: str, val: object) -> object:
+    """根据列名格式化日期字段。"""
+    fmt = _FORMATTERS.get(col)
+    return fmt(val) if fmt else val
+
+# 移除 `_annotate_stage` 函数。临床分期映射功能已取消，不再补充分期字段。
 
 
 def _reorder_pathology(row_dict: dict) -> dict:
@@ -112,99 +131,86 @@ def _reorder_pathology(row_dict: dict) -> dict:
     return row_dict
 
 
-def _annotate_sequence(rows: List[dict], table_name: str) -> List[dict]:
-    """Add a sequence number (1, 2, 3...) for each patient's records sorted by date.
-    
-    Applicable to Surgery, Pathology, Molecular, and FollowUpEvent tables.
+def _sheet_header(columns: Iterable[str], sheet_name: str) -> List[str]:
+    """Column order for a sheet: excluded fields dropped, Seq first."""
+    header = [k for k in columns if k not in EXCLUDE_FIELDS]
+    # For Pathology sheet reorder airway_spread before pleural_invasion
+    if sheet_name == "Pathology":
+        header = list(_reorder_pathology(dict.fromkeys(header)))
+    # Ensure 'Seq' is the first column if present
+    if "Seq" in header:
+        header.remove("Seq")
+        header = ["Seq"] + header
+    return header
+
+
+def _make_row_transformer(
+    header: List[str], row_keys: Optional[Sequence[str]] = None
+) -> Callable[[Union[dict, tuple]], list]:
+    """Compile a sheet's header into one function from row to cell values.
+
+    Rows are dicts by default; pass ``row_keys`` (the column name of each
+    position) to read tuple rows by position instead.
+    """
+    if row_keys is not None:
+        keys = list(row_keys)
+        positions = tuple((keys.index(k), _FORMATTERS.get(k)) for k in header)
+
+        def transform_row(row: tuple) -> list:
+            return [fmt(row[i]) if fmt else row[i] for i, fmt in positions]
+
+        return transform_row
+
+    columns = tuple((k, _FORMATTERS.get(k)) for k in header)
+
+    def transform(row: dict) -> list:
+        get = row.get
+        return [fmt(get(k)) if fmt else get(k) for k, fmt in columns]
+
+    return transform
+
+
+def _write_sheet(
+    wb: Workbook,
+    sheet_name: str,
+    rows: Iterable[Union[dict, tuple]],
+    row_keys: Optional[Sequence[str]] = None,
+) -> None:
+    """写入工作表数据，包含异常处理。
+
+    表头由首行（或元组行的列名 row_keys）一次确定，之后每行直接按表头顺序
+    格式化为单元格值写入。
     """
-    if table_name not in ["Surgery", "Pathology", "Molecular", "FollowUpEvent"]:
-        return rows
-    
-    # Sort all rows by date to ensure consistent numbering
-    date_field_map = {
-        "Surgery": "surgery_date6",
-        "Pathology": "pathology_date",
-        "Molecular": "test_date",
-        "FollowUpEvent": "event_date"
-    }
-    date_col = date_field_map.get(table_name)
-    if not date_col:
-        return rows
-
-    # Group rows by patient_id
-    grouped = {}
-    for row in rows:
-        pid = row.get("patient_id")
-        if pid not in grouped:
-            grouped[pid] = []
-        grouped[pid].append(row)
-    
-    annotated_rows = []
-    # For each patient, sort by date ascending and assign sequence
-    for pid in grouped:
-        patient_rows = grouped[pid]
-        # Sort by date ascending
-        patient_rows.sort(key=lambda x: str(x.get(date_col) or ""))
-        
-        for i, row in enumerate(patient_rows, 1):
-            # Create a new dict to avoid modifying original if shared
-            new_row = row.copy()
-            # Add sequence column with a generic name like 'Seq' or specific '{Table}_Seq'
-            # Using generic 'Seq' as it is clear within the sheet context
-            new_row["Seq"] = i
-            annotated_rows.append(new_row)
-            
-    return annotated_rows
-
-
-def _write_sheet(wb: Workbook, sheet_name: str, rows: Iterable[dict]) -> None:
-    """写入工作表数据，包含异常处理。"""
     try:
         ws = wb.create_sheet(title=sheet_name)
         
-        # Convert to list
-        rows_list_raw = [dict(row) if not isinstance(row, dict) else row for row in rows]
+        row_iter = iter(rows)
+        # 序号列 Seq 已由导出查询生成
+        first_row = next(row_iter, None)
+        if first_row is None:
+            return
         
-        # Calculate sequences before cleaning (cleaning might remove fields needed for sorting?)
-        # No, cleaning just formats dates. Better to annotate first.
-        if sheet_name in ["Surgery", "Pathology", "Molecular", "FollowUpEvent"]:
-            rows_list_raw = _annotate_sequence(rows_list_raw, sheet_name)
-            
-        # Clean and format
-        rows_list = []
-        for row_dict in rows_list_raw:
+        header = _sheet_header(first_row if row_keys is None else row_keys, sheet_name)
+        transform = _make_row_transformer(header, row_keys)
+        ws.append(header)
+        for row in itertools.chain((first_row,), row_iter):
             try:
-                cleaned = _clean_row(row_dict)
-                # For Pathology sheet reorder airway_spread before pleural_invasion
-                if sheet_name == "Pathology":
-                    cleaned = _reorder_pathology(cleaned)
-                rows_list.append(cleaned)
+                values = transform(row)
             except Exception as e:
                 print(f"Warning: Failed to process row in {sheet_name}: {e}")
                 continue
-        
-        if not rows_list:
-            return
-        
-        # Write header based on cleaned row keys (order matters)
-        # Ensure 'Seq' is the first column if present
-        first_keys = list(rows_list[0].keys())
-        if "Seq" in first_keys:
-            first_keys.remove("Seq")
-            header = ["Seq"] + first_keys
-        else:
-            header = first_keys
-            
-        ws.append(header)
-        for row in rows_list:
-            # Convert sqlite3.Row to dict to support .get() method
-            row_dict = dict(row)
-            ws.append([row_dict.get(col) for col in header])
+            ws.append(values)
     except Exception as e:
         print(f"Error: Failed to write sheet {sheet_name}: {e}")
         raise
 
 
+def _save_workbook(wb: Workbook, file_path: Path) -> None:
+    """保存工作簿；经大缓冲区写出，zipfile 的大量小块写入合并为少量系统调用。"""
+    with file_path.open("wb", buffering=WRITE_BUFFER_SIZE) as f:
+        wb.save(f)
+
+
 def export_patient_to_excel(
     db: Database, 
     patient_id: int, 
@@ -220,9 +226,9 @@ def export_patient_to_excel(
         progress_callback: 进度回调函数，接收 0-100 的进度值
     """
     try:
-        wb = Workbook()
-        # Remove the default sheet created by openpyxl
-        wb.remove(wb.active)
+        # 只写模式：行随写随序列化到临时文件，不为每个单元格保留 Cell 对象；
+        # 该模式下没有默认工作表
+        wb = Workbook(write_only=True)
         
         tables = ["Patient", "Surgery", "Pathology", "Molecular", "FollowUpEvent"]
         
@@ -240,7 +246,9 @@ def export_patient_to_excel(
         table_data = parallel_fetch_tables(
             db, tables, patient_id=patient_id,
             max_workers=min(4, len(tables)),
-            progress_tracker=fetch_progress
+            progress_tracker=fetch_progress,
+            exclude=EXCLUDE_FIELDS,
+            with_sequence=True,
         )
         
         # 获取患者的 hospital_id
@@ -279,7 +287,7 @@ def export_patient_to_excel(
         if progress_callback:
             progress_callback(95)
         
-        wb.save(file_path)
+        _save_workbook(wb, file_path)
         
         if progress_callback:
             progress_callback(100)
@@ -303,53 +311,30 @@ def export_all_to_excel(
         progress_callback: 进度回调函数，接收 0-100 的进度值
     """
     try:
-        wb = Workbook()
-        # Remove default sheet
-        wb.remove(wb.active)
+        # 只写模式：行随写随序列化到临时文件，不为每个单元格保留 Cell 对象；
+        # 该模式下没有默认工作表
+        wb = Workbook(write_only=True)
         
         tables = ["Patient", "Surgery", "Pathology", "Molecular", "FollowUpEvent"]
         
-        # 创建进度跟踪器（数据获取占 70%，写入占 30%）
         if progress_callback:
             progress_callback(5)
         
-        # 使用多线程并行获取所有表的数据
-        fetch_progress = ExportProgress(len(tables))
-        if progress_callback:
-            def fetch_progress_callback(p):
-                # 数据获取阶段占 70% 进度
-                progress_callback(5 + p * 0.7)
-            fetch_progress.set_callback(fetch_progress_callback)
-        
-        table_data = parallel_fetch_tables(
-            db, tables, patient_id=None, 
-            max_workers=min(4, len(tables)),
-            progress_tracker=fetch_progress
-        )
-        
-        # Precompute mapping from patient_id to hospital_id
-        patient_rows = table_data.get("Patient", [])
-        pat_map = {}
-        for rdict in patient_rows:
-            pat_map[rdict.get("patient_id")] = rdict.get("hospital_id")
-        
-        # 处理并写入每个表
-        write_progress_step = 30.0 / len(tables) if len(tables) > 0 else 0
+        # 逐表从只读连接的游标边读边写入工作表，整表数据不驻留内存；
+        # 非 Patient 表的 hospital_id 在查询时关联得到
+        write_progress_step = 90.0 / len(tables) if len(tables) > 0 else 0
         for idx, table in enumerate(tables):
             try:
-                rows_dicts: List[dict] = table_data.get(table, [])
-                
-                # Attach hospital_id for non-Patient tables
-                if table != "Patient":
-                    for rdict in rows_dicts:
-                        pid = rdict.get("patient_id")
-                        if pid in pat_map:
-                            rdict["hospital_id"] = pat_map[pid]
-                
-                _write_sheet(wb, table, rows_dicts)
+                with stream_table_data(
+                    db, table,
+                    exclude=EXCLUDE_FIELDS,
+                    with_sequence=True,
+                    with_hospital_id=True,
+                ) as (names, rows):
+                    _write_sheet(wb, table, rows, names)
                 
                 if progress_callback:
-                    progress_callback(75 + (idx + 1) * write_progress_step)
+                    progress_callback(5 + (idx + 1) * write_progress_step)
                     
             except Exception as e:
                 print(f"Warning: Failed to export table {table}: {e}")
@@ -361,7 +346,7 @@ def export_all_to_excel(
         if progress_callback:
             progress_callback(95)
         
-        wb.save(file_path)
+        _save_workbook(wb, file_path)
         
         if progress_callback:
             progress_callback(100)
@@ -8,10 +8,14 @@
 from __future__ import annotations
 
 import concurrent.futures
-from typing import List, Dict, Callable, Any, Optional, Tuple
+import concurrent.futures.process
+import multiprocessing
+from contextlib import contextmanager
+from functools import lru_cache, partial
+from typing import List, Dict, Callable, Any, Optional, Tuple, Iterable, Iterator, FrozenSet
 from pathlib import Path
 
-from db.models import Database
+from db.models import Database, open_ro_connection
 from utils.logger import log_error, log_warning, log_debug
 
 
@@ -38,61 +42,210 @@ class ExportProgress:
             self.callback(100.0)
 
 
-def fetch_table_data(db: Database, table: str, patient_id: Optional[int] = None) -> Tuple[str, List[Dict]]:
+# 单个患者导出时各表的排序方式；不在此表中的表不支持按患者导出
+_PATIENT_ORDER_BY = {
+    "Patient": "",
+    "Surgery": " ORDER BY surgery_date6 DESC",
+    "Pathology": " ORDER BY path_id DESC",
+    "Molecular": " ORDER BY test_date DESC",
+    "FollowUpEvent": " ORDER BY event_date DESC",
+}
+
+# 需要生成序号 (Seq) 的表及其排序日期列：每位患者的记录按日期升序编号
+SEQUENCE_DATE_COLUMNS = {
+    "Surgery": "surgery_date6",
+    "Pathology": "pathology_date",
+    "Molecular": "test_date",
+    "FollowUpEvent": "event_date",
+}
+
+def _qualified_order(table: str) -> str:
+    """_PATIENT_ORDER_BY 中的排序项加上表别名 t.，避免被同名的格式化结果列遮蔽"""
+    terms = _PATIENT_ORDER_BY[table].replace(" ORDER BY ", "", 1).split(", ")
+    return ", ".join(f"t.{term}" for term in terms)
+
+
+@lru_cache(maxsize=None)
+def _export_sql(
+    table: str,
+    columns: Tuple[str, ...],
+    per_patient: bool,
+    with_hospital_id: bool,
+    with_sequence: bool,
+    column_sql: Tuple[Tuple[str, str], ...] = (),
+) -> str:
+    """拼出导出查询（按参数组合缓存）
+
+    with_sequence 时由窗口函数 ROW_NUMBER() 生成 Seq 列并作为第一列，
+    结果按患者分组（患者按其首条记录的先后排列）、组内按 Seq 排序。
+    column_sql 为 ((列名, SQL 表达式模板), ...)，模板中的 {col} 替换为该列，
+    结果仍以原列名输出；排序始终使用列的原始值。
+    """
+    expressions = dict(column_sql)
+    select = [
+        f"{expressions[c].format(col=f't.{c}')} AS {c}" if c in expressions else f"t.{c}"
+        for c in columns
+    ] or ["t.*"]
+    join = ""
+    if with_hospital_id and table != "Patient":
+        # hospital_id 由 SQLite 按 patient_id 关联 Patient 得到
+        select.append("p.hospital_id")
+        join = " LEFT JOIN Patient AS p ON p.patient_id = t.patient_id"
+    where = " WHERE t.patient_id=?" if per_patient else ""
+    date_column = SEQUENCE_DATE_COLUMNS.get(table) if with_sequence else None
+    if date_column:
+        # 日期相同的记录按原查询顺序编号：单个患者沿用该表的排序方式，全库按插入顺序
+        if per_patient:
+            tie_break = _qualified_order(table) + ", t.rowid"
+        else:
+            tie_break = "t.rowid"
+        select.insert(
+            0,
+            f"ROW_NUMBER() OVER (PARTITION BY t.patient_id "
+            f"ORDER BY COALESCE(t.{date_column}, ''), {tie_break}) AS Seq",
+        )
+        if per_patient:
+            order_by = " ORDER BY Seq"
+        else:
+            order_by = " ORDER BY MIN(t.rowid) OVER (PARTITION BY t.patient_id), Seq"
+    elif per_patient and _PATIENT_ORDER_BY[table]:
+        order_by = f" ORDER BY {_qualified_order(table)}"
+    else:
+        order_by = ""
+    return f"SELECT {','.join(select)} FROM {table} AS t{join}{where}{order_by}"
+
+
+# 每批从游标取出的行数
+FETCH_BATCH_SIZE = 1000
+
+# (数据库路径, 表名) -> 列名，每张表只读取一次表结构
+_COLUMNS_CACHE: Dict[Tuple[str, str], Tuple[str, ...]] = {}
+
+
+def _table_columns(db_path: str, conn, table: str) -> Tuple[str, ...]:
+    """返回 table 的全部列名（按表缓存）"""
+    key = (db_path, table)
+    columns = _COLUMNS_CACHE.get(key)
+    if columns is None:
+        columns = tuple(row[1] for row in conn.execute(f"PRAGMA table_info({table})"))
+        _COLUMNS_CACHE[key] = columns
+    return columns
+
+
+def _execute_export(
+    conn,
+    db_path: str,
+    table: str,
+    patient_id: Optional[int] = None,
+    exclude: Iterable[str] = (),
+    with_hospital_id: bool = False,
+    with_sequence: bool = False,
+    column_sql: Optional[Dict[str, str]] = None,
+) -> Tuple[List[str], Iterator[tuple]]:
+    """在 conn 上执行导出查询（参数同 fetch_table_data），返回 (列名, 元组行迭代器)
+
+    行直接取游标的元组，不构造 sqlite3.Row 或字典，列名只从 cursor.description
+    读取一次；行分批从游标取出，任一时刻只有一批驻留内存。
     """
-    从数据库获取表数据（线程安全 - 使用独立连接）
+    excluded = frozenset(exclude)
+    columns = tuple(c for c in _table_columns(db_path, conn, table) if c not in excluded)
+    sql = _export_sql(
+        table, columns, bool(patient_id), with_hospital_id, with_sequence,
+        tuple(sorted(column_sql.items())) if column_sql else (),
+    )
+    cursor = conn.cursor()
+    cursor.row_factory = None
+    if patient_id:
+        # 获取单个患者数据
+        cursor.execute(sql, (patient_id,))
+    else:
+        # 获取全部数据
+        cursor.execute(sql)
+    names = [d[0] for d in cursor.description]
+
+    def iter_rows() -> Iterator[tuple]:
+        try:
+            while True:
+                batch = cursor.fetchmany(FETCH_BATCH_SIZE)
+                if not batch:
+                    break
+                yield from batch
+        finally:
+            cursor.close()
+
+    return names, iter_rows()
+
+
+def fetch_table_data(
+    db: Database,
+    table: str,
+    patient_id: Optional[int] = None,
+    exclude: Iterable[str] = (),
+    with_hospital_id: bool = False,
+    with_sequence: bool = False,
+    column_sql: Optional[Dict[str, str]] = None,
+) -> Tuple[str, List[Dict]]:
+    """
+    从数据库获取表数据（线程安全 - 使用连接池中的只读连接）
     
     Args:
-        db: 数据库实例（仅用于获取db_path）
+        db: 数据库实例（提供只读连接池）
         table: 表名
         patient_id: 患者 ID（None 表示获取全部）
+        exclude: 不需要导出的列，直接在 SELECT 中略去
+        with_hospital_id: 为非 Patient 表的每行附加所属患者的 hospital_id
+        with_sequence: 为 Surgery/Pathology/Molecular/FollowUpEvent 生成序号列 Seq
+        column_sql: {列名: SQL 表达式模板}，在查询中完成这些列的格式化
     
     Returns:
         (表名, 数据行列表)
     """
-    import sqlite3
-    
-    # 为线程安全，每个线程使用独立的连接
-    # 不需要check_same_thread=False，因为每个线程都创建自己的连接
-    conn = None
+    if patient_id and table not in _PATIENT_ORDER_BY:
+        return (table, [])
     try:
-        conn = sqlite3.connect(db.db_path)
-        conn.row_factory = sqlite3.Row
-        
-        if patient_id:
-            # 获取单个患者数据
-            if table == "Patient":
-                row = conn.execute("SELECT * FROM Patient WHERE patient_id=?", (patient_id,)).fetchone()
-                rows = [dict(row)] if row else []
-            elif table == "Surgery":
-                cursor = conn.execute("SELECT * FROM Surgery WHERE patient_id=? ORDER BY surgery_date6 DESC", (patient_id,))
-                rows = [dict(r) for r in cursor.fetchall()]
-            elif table == "Pathology":
-                cursor = conn.execute("SELECT * FROM Pathology WHERE patient_id=? ORDER BY path_id DESC", (patient_id,))
-                rows = [dict(r) for r in cursor.fetchall()]
-            elif table == "Molecular":
-                cursor = conn.execute("SELECT * FROM Molecular WHERE patient_id=? ORDER BY test_date DESC", (patient_id,))
-                rows = [dict(r) for r in cursor.fetchall()]
-            elif table == "FollowUpEvent":
-                cursor = conn.execute("SELECT * FROM FollowUpEvent WHERE patient_id=? ORDER BY event_date DESC", (patient_id,))
-                rows = [dict(r) for r in cursor.fetchall()]
-            else:
-                rows = []
-        else:
-            # 获取全部数据
-            cursor = conn.execute(f"SELECT * FROM {table}")
-            rows = [dict(r) for r in cursor.fetchall()]
+        # 从只读连接池借用连接：各线程互不共享同一连接，且不必每次重新打开
+        with db.acquire_ro() as conn:
+            names, values = _execute_export(
+                conn, str(db.db_path), table, patient_id, exclude,
+                with_hospital_id, with_sequence, column_sql,
+            )
+            rows = [dict(zip(names, row)) for row in values]
         
         return (table, rows)
     except Exception as e:
         log_error(f"获取表 {table} 数据失败: {e}", e)
         return (table, [])
-    finally:
-        if conn:
-            try:
-                conn.close()
-            except:
-                pass
+
+
+@contextmanager
+def stream_table_data(
+    db: Database,
+    table: str,
+    patient_id: Optional[int] = None,
+    exclude: Iterable[str] = (),
+    with_hospital_id: bool = False,
+    with_sequence: bool = False,
+    column_sql: Optional[Dict[str, str]] = None,
+) -> Iterator[Tuple[List[str], Iterator[tuple]]]:
+    """借用只读连接执行与 fetch_table_data 相同的导出查询，产出 (列名, 元组行迭代器)
+
+    行在 with 块内边读边用，整表数据不会同时驻留内存；离开 with 块后连接归还连接池。
+
+    用法::
+
+        with stream_table_data(db, "Surgery", with_sequence=True) as (names, rows):
+            for row in rows:
+                ...
+    """
+    with db.acquire_ro() as conn:
+        names, rows = _execute_export(
+            conn, str(db.db_path), table, patient_id, exclude,
+            with_hospital_id, with_sequence, column_sql,
+        )
+        try:
+            yield names, rows
+        finally:
+            rows.close()
 
 
 def parallel_fetch_tables(
@@ -100,7 +253,11 @@ def parallel_fetch_tables(
     tables: List[str],
     patient_id: Optional[int] = None,
     max_workers: int = 4,
-    progress_tracker: Optional[ExportProgress] = None
+    progress_tracker: Optional[ExportProgress] = None,
+    exclude: Iterable[str] = (),
+    with_hospital_id: bool = False,
+    with_sequence: bool = False,
+    column_sql: Optional[Dict[str, str]] = None,
 ) -> Dict[str, List[Dict]]:
     """
     并行获取多个表的数据
@@ -111,6 +268,10 @@ def parallel_fetch_tables(
         patient_id: 患者 ID（None 表示导出全库）
         max_workers: 最大线程数
         progress_tracker: 进度跟踪器
+        exclude: 不需要导出的列
+        with_hospital_id: 为非 Patient 表附加 hospital_id 列
+        with_sequence: 按日期为各患者的记录生成序号列 Seq
+        column_sql: {列名: SQL 表达式模板}，在查询中完成这些列的格式化
     
     Returns:
         {表名: 数据行列表} 的字典
@@ -120,7 +281,9 @@ def parallel_fetch_tables(
     # 对于小数据量，直接串行处理更快
     if len(tables) <= 2:
         for table in tables:
-            table_name, rows = fetch_table_data(db, table, patient_id)
+            table_name, rows = fetch_table_data(
+                db, table, patient_id, exclude, with_hospital_id, with_sequence, column_sql
+            )
             result[table_name] = rows
             if progress_tracker:
                 progress_tracker.update()
@@ -130,7 +293,10 @@ def parallel_fetch_tables(
     with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
         # 提交所有任务
         future_to_table = {
-            executor.submit(fetch_table_data, db, table, patient_id): table
+            executor.submit(
+                fetch_table_data, db, table, patient_id, exclude, with_hospital_id,
+                with_sequence, column_sql,
+            ): table
             for table in tables
         }
         
@@ -149,6 +315,83 @@ def parallel_fetch_tables(
     return result
 
 
+# 全库导出时，各表估算行数合计达到此值才改用进程池；
+# 行数较少时进程启动的开销超过并行格式化带来的收益
+PROCESS_WRITE_MIN_ROWS = 50000
+
+
+def estimate_table_rows(db: Database, tables: Iterable[str]) -> int:
+    """按各表最大 rowid 估算总行数
+
+    MAX(rowid) 只需读取主键 B 树的最右端，不必像 COUNT(*) 那样扫描整表；
+    删除过记录时估算值偏大，仅用于选择线程池或进程池。
+    """
+    with db.acquire_ro() as conn:
+        return sum(
+            conn.execute(f"SELECT MAX(rowid) FROM {table}").fetchone()[0] or 0
+            for table in tables
+        )
+
+
+def _write_task(write_func, path, rows, table_name):
+    """线程池中的单个写入任务"""
+    write_func(path, rows, table_name)
+    return path
+
+
+def export_table_file(
+    db_path: str,
+    path: Path,
+    table: str,
+    write_func: Callable[[Path, Iterable[tuple], str, List[str]], None],
+    exclude: Iterable[str] = (),
+    with_hospital_id: bool = False,
+    with_sequence: bool = False,
+    column_sql: Optional[Dict[str, str]] = None,
+) -> Path:
+    """打开独立的只读连接，把 table 的导出行边查询边交给 write_func 写入 path
+
+    write_func 接收 (文件路径, 元组行迭代器, 表名, 列名)，整表数据不会同时驻留内存；
+    定义在模块级，可在线程或进程池中执行。
+    """
+    conn = open_ro_connection(db_path)
+    try:
+        names, rows = _execute_export(
+            conn, db_path, table, None, exclude, with_hospital_id, with_sequence, column_sql
+        )
+        write_func(path, rows, table, names)
+    finally:
+        conn.close()
+    return path
+
+
+def _run_file_tasks(
+    executor: concurrent.futures.Executor,
+    task: Callable[..., Path],
+    task_args: List[Tuple],
+    progress_tracker: Optional[ExportProgress],
+    written_files: List[Path],
+) -> None:
+    """在给定的执行器中提交生成文件的任务（首个参数为文件路径）并收集结果
+
+    进程池异常终止 (BrokenProcessPool) 时向上抛出，由调用方改用线程重试；
+    其余异常按文件记录日志。
+    """
+    future_to_path = {executor.submit(task, *args): args[0] for args in task_args}
+
+    for future in concurrent.futures.as_completed(future_to_path):
+        try:
+            path = future.result()
+            written_files.append(path)
+            if progress_tracker:
+                progress_tracker.update()
+        except concurrent.futures.process.BrokenProcessPool:
+            raise
+        except Exception as e:
+            failed_path = future_to_path[future]
+            log_error(f"写入文件 {failed_path} 失败: {e}", e)
+
+
 def parallel_write_csv_files(
     file_tasks: List[Tuple[Path, List[Dict], str]],
     write_func: Callable[[Path, List[Dict], str], None],
@@ -182,25 +425,71 @@ def parallel_write_csv_files(
         return written_files
     
     # 使用线程池并行写入
-    def write_task(path, rows, table_name):
-        write_func(path, rows, table_name)
-        return path
-    
     with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
-        future_to_path = {
-            executor.submit(write_task, path, rows, table_name): path
-            for path, rows, table_name in file_tasks
-        }
-        
-        for future in concurrent.futures.as_completed(future_to_path):
-            try:
-                path = future.result()
-                written_files.append(path)
-                if progress_tracker:
-                    progress_tracker.update()
-            except Exception as e:
-                failed_path = future_to_path[future]
-                log_error(f"写入文件 {failed_path} 失败: {e}", e)
+        _run_file_tasks(
+            executor, partial(_write_task, write_func), file_tasks,
+            progress_tracker, written_files,
+        )
     
     return written_files
 
+
+def parallel_export_tables(
+    db: Database,
+    file_tasks: List[Tuple[Path, str]],
+    write_func: Callable[[Path, Iterable[tuple], str, List[str]], None],
+    max_workers: int = 4,
+    progress_tracker: Optional[ExportProgress] = None,
+    use_processes: bool = False,
+    exclude: Iterable[str] = (),
+    with_hospital_id: bool = False,
+    with_sequence: bool = False,
+    column_sql: Optional[Dict[str, str]] = None,
+) -> List[Path]:
+    """
+    并行导出整表到文件：每张表在各自的工作线程/进程中边查询边写入
+    
+    与先 parallel_fetch_tables 再 parallel_write_csv_files 不同，行数据从游标
+    直接流向文件，内存占用与表的大小无关。
+    
+    Args:
+        db: 数据库实例（提供数据库路径；工作者各自打开只读连接）
+        file_tasks: [(文件路径, 表名), ...] 列表
+        write_func: 写入函数，接收 (文件路径, 元组行迭代器, 表名, 列名)
+        max_workers: 最大工作者数
+        progress_tracker: 进度跟踪器，每写完一个文件更新一次
+        use_processes: 改用进程池（spawn 方式启动），使各表的格式化与编码不受
+            GIL 限制；此时 write_func 须可被 pickle（模块级函数或其
+            functools.partial）。默认使用线程池
+        exclude / with_hospital_id / with_sequence / column_sql: 同 fetch_table_data
+    
+    Returns:
+        成功写入的文件路径列表
+    """
+    written_files: List[Path] = []
+    task = partial(
+        export_table_file, str(db.db_path),
+        write_func=write_func, exclude=frozenset(exclude), with_hospital_id=with_hospital_id,
+        with_sequence=with_sequence, column_sql=column_sql,
+    )
+    
+    if use_processes:
+        # 调用方通常运行在 GUI 的工作线程中，fork 多线程进程可能死锁，
+        # 因此固定使用 spawn 启动子进程
+        try:
+            with concurrent.futures.ProcessPoolExecutor(
+                max_workers=max_workers, mp_context=multiprocessing.get_context("spawn"),
+            ) as executor:
+                _run_file_tasks(executor, task, file_tasks, progress_tracker, written_files)
+            return written_files
+        except (concurrent.futures.process.BrokenProcessPool, OSError) as e:
+            # 进程无法启动（如受限环境）或中途异常退出时，剩余文件改用线程写入
+            log_warning(f"进程池导出失败，改用线程导出: {e}")
+            done = set(written_files)
+            file_tasks = [t for t in file_tasks if t[0] not in done]
+    
+    # sqlite3 执行查询时释放 GIL，各表的查询与写入可以相互重叠
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        _run_file_tasks(executor, task, file_tasks, progress_tracker, written_files)
+    
+    return written_files
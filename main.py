@@ -2,6 +2,7 @@
 from __future__ import annotations
 
 import sys, os
+import multiprocessing
 import sqlite3
 import threading
 import shutil
@@ -17,7 +18,7 @@ import ttkbootstrap as tb
 from ttkbootstrap.constants import *
 
 # 下面全部用"绝对导入"（不带.或..）
-from db.models import Database, DEFAULT_DB_PATH
+from db.models import Database, DEFAULT_DB_PATH, open_source_db
 from ui.patient_tab import PatientTab
 from ui.surgery_tab import SurgeryTab
 from ui.path_tab import PathologyTab
@@ -25,7 +26,7 @@ from ui.mol_tab import MolecularTab
 from ui.fu_tab import FollowUpTab
 from ui.export_tab import ExportTab
 from staging.lookup import load_mapping_from_csv
-from db.migrate import migrate_database
+from db.migrate import generate_unique_event_code
 
 
 class ThoracicApp:
@@ -38,10 +39,8 @@ class ThoracicApp:
         # 初始化数据库
         # 使用 models.py 中定义的智能路径（适配 EXE 和开发环境）
         self.db_path = DEFAULT_DB_PATH
+        # Database 在结构版本落后时会在同一连接上完成建表与迁移
         self.db = Database(self.db_path)
-        
-        # 执行数据库迁移
-        migrate_database(self.db_path)
 
         # 当前患者状态
         # 统一使用 patient_id 和 hospital_id 保存当前选中患者的标识
@@ -229,23 +228,21 @@ class ThoracicApp:
         for item in self.patient_tree.get_children():
             self.patient_tree.delete(item)
 
-        # 获取所有患者
-        cursor = self.db.conn.execute(
-            "SELECT patient_id, hospital_id, cancer_type FROM Patient ORDER BY patient_id DESC"
-        )
-        all_patients = cursor.fetchall()
-
-        # 应用筛选
+        # 获取患者；癌种筛选交给 SQLite（可用 idx_patient_cancer_type 索引）
         search_text = self.search_var.get().strip().lower()
         filter_type = self.filter_var.get()
+        sql = "SELECT patient_id, hospital_id, cancer_type FROM Patient"
+        params = ()
+        if filter_type != "全部":
+            sql += " WHERE cancer_type = ?"
+            params = (filter_type,)
+        cursor = self.db.conn.execute(sql + " ORDER BY patient_id DESC", params)
+        all_patients = cursor.fetchall()
 
+        # 应用住院号/ID 子串筛选
         for row in all_patients:
             patient_id, hospital_id, cancer_type = row
             
-            # 筛选逻辑
-            if filter_type != "全部" and cancer_type != filter_type:
-                continue
-            
             if search_text:
                 if search_text not in str(patient_id).lower() and \
                    search_text not in (hospital_id or "").lower():
@@ -499,22 +496,13 @@ class ThoracicApp:
         
         # 辅助函数：在线程中生成唯一的event_code
         def generate_unique_event_code_in_thread(conn, patient_id):
-            """在导入线程中生成唯一的随访事件编码"""
-            import random
-            import string
-            alphabet = string.digits
-            max_attempts = 100
-            for _ in range(max_attempts):
-                candidate = ''.join(random.choices(alphabet, k=6))
-                exists = conn.execute(
-                    "SELECT 1 FROM FollowUpEvent WHERE patient_id=? AND event_code=?",
-                    (patient_id, candidate)
-                ).fetchone()
-                if not exists:
-                    return candidate
-            # 如果100次都冲突，使用时间戳+随机数（几乎不可能失败）
-            import time
-            return f"{int(time.time() * 1000) % 1000000}"
+            """在导入线程中生成唯一的随访事件编码（一次查询已占用编码，在内存中挑选）"""
+            used = {
+                row[0] for row in conn.execute(
+                    "SELECT event_code FROM FollowUpEvent WHERE patient_id=?", (patient_id,)
+                )
+            }
+            return generate_unique_event_code(used)
         
         # 准备在后台线程中运行
         def run_import():
@@ -551,7 +539,7 @@ class ThoracicApp:
                     self.root.after(0, lambda m=f"正在导入 ({idx+1}/{db_count}): {db_name}": self.status(m))
                     
                     try:
-                        src_conn = sqlite3.connect(source_db)
+                        src_conn = open_source_db(source_db)
                         src_conn.row_factory = sqlite3.Row
 
                         # 获取所有患者
@@ -924,6 +912,16 @@ class ThoracicApp:
             messagebox.showerror("错误", f"健康检查失败：\n\n{str(e)}")
             self.status("健康检查失败")
     
+    def close_database(self):
+        """退出前把 WAL 中已提交的数据写回主库文件并关闭连接
+
+        关闭后 thoracic.db 单独即为完整的数据库，-wal/-shm 文件随之删除。
+        """
+        try:
+            self.db.checkpoint()
+        finally:
+            self.db.close()
+
     def backup_database(self):
         """备份当前数据库文件"""
         # 生成默认备份文件名（使用当前日期）
@@ -942,6 +940,9 @@ class ThoracicApp:
             return
         
         try:
+            # WAL 模式下已提交的数据可能仍在 -wal 文件中，先写回主库文件
+            self.db.checkpoint()
+            
             # 获取源数据库文件大小
             source_size = self.db_path.stat().st_size / 1024 / 1024  # MB
             
@@ -1067,10 +1068,15 @@ def main():
         root = tk.Tk()
     
     app = ThoracicApp(root)
-    root.mainloop()
+    try:
+        root.mainloop()
+    finally:
+        app.close_database()
 
 
 if __name__ == "__main__":
+    # 打包为 EXE 后，大数据量全库导出使用的进程池（spawn）子进程需经此入口分派
+    multiprocessing.freeze_support()
     main()
 
 
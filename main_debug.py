@@ -6,8 +6,13 @@ from __future__ import annotations
 
 import sys
 import os
+import multiprocessing
 from pathlib import Path
 
+# 导出进程池的子进程在打包环境下由此分派，不再重复打印调试信息
+if __name__ == "__main__":
+    multiprocessing.freeze_support()
+
 print("=" * 60)
 print("调试信息 - 启动前")
 print("=" * 60)
@@ -108,7 +113,10 @@ try:
     print("✅ ThoracicApp初始化成功")
     
     print("\n启动主循环...")
-    root.mainloop()
+    try:
+        root.mainloop()
+    finally:
+        app.close_database()
     
 except Exception as e:
     print(f"\n❌ 启动失败: {e}")
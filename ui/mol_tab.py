@@ -334,23 +334,25 @@ class MolecularTab(ttk.Frame):
             else:
                 # 编辑现有记录时，保留孤儿字段（UI中没有输入框的字段）的原值
                 # 这样可以避免编辑后导致旧数据丢失
-                try:
-                    old_row = self.db.conn.execute(
-                        "SELECT genes_tested, result_summary FROM Molecular WHERE mol_id=?",
-                        (self.current_record_id,)
-                    ).fetchone()
-                    if old_row:
-                        old_dict = dict(old_row)
-                        # 保留原有的 genes_tested 和 result_summary
-                        if old_dict.get("genes_tested") is not None:
-                            data["genes_tested"] = old_dict["genes_tested"]
-                        if old_dict.get("result_summary") is not None:
-                            data["result_summary"] = old_dict["result_summary"]
-                except Exception as e:
-                    # 如果获取旧值失败，继续保存（不影响主流程）
-                    print(f"Warning: Failed to preserve orphan fields: {e}")
+                # 读取旧值与更新放在同一事务中，期间其他连接无法改写该记录
+                with self.db.transaction():
+                    try:
+                        old_row = self.db.conn.execute(
+                            "SELECT genes_tested, result_summary FROM Molecular WHERE mol_id=?",
+                            (self.current_record_id,)
+                        ).fetchone()
+                        if old_row:
+                            old_dict = dict(old_row)
+                            # 保留原有的 genes_tested 和 result_summary
+                            if old_dict.get("genes_tested") is not None:
+                                data["genes_tested"] = old_dict["genes_tested"]
+                            if old_dict.get("result_summary") is not None:
+                                data["result_summary"] = old_dict["result_summary"]
+                    except Exception as e:
+                        # 如果获取旧值失败，继续保存（不影响主流程）
+                        print(f"Warning: Failed to preserve orphan fields: {e}")
                 
-                self.db.update_molecular(self.current_record_id, data)
+                    self.db.update_molecular(self.current_record_id, data)
                 messagebox.showinfo("成功", "分子记录已更新")
             # 保存完成后刷新列表
             self.load_patient(self.app.current_patient_id)
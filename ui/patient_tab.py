@@ -731,7 +731,7 @@ class PatientTab(ttk.Frame):
                 log_debug(f"使用当前患者ID: {pid}")
             else:
                 log_debug(f"查询已存在的患者: {hospital_id}")
-                existing = self.db.get_patient_by_hospital_id(hospital_id)
+                existing = self.db.get_patient_by_hospital_id(hospital_id, columns=("patient_id",))
                 if existing:
                     try:
                         # 将 sqlite3.Row 转换为字典以确保跨环境兼容性